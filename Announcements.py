@@ -1,18 +1,23 @@
 import Filters
 import Config
+import time
+from array import array
+from bisect import bisect_left
 
 class announcement(object):
-    def __init__(self, string):
-        group, category = Filters.expressions.find_expression(string)
+    __slots__ = ('text', 'category_id')
+
+    def __init__(self, string, category_id=None):
+        if category_id is None:
+            category_id = Filters.expressions.find_category_id(string)
         if type(string) is bytes:
             self.text = string.decode('cp437')
         else:
             self.text = string
-        if group == None or category == None:
+        if category_id < 0:
             print(string)
             raise UserWarning("Nonetype object lookup, string:%s" % (string))  # TODO: remove
-        self.group_name = group.group
-        self.category_name = category.category
+        self.category_id = category_id
 
     def get_text(self, show_group=False, newline=True):
         if show_group:
@@ -24,17 +29,151 @@ class announcement(object):
                 return self.text
 
     def get_group(self):
-        return self.group_name
+        return Filters.expressions.registry.group_names[self.category_id]
 
     def get_category(self):
-        return self.category_name
+        return Filters.expressions.registry.category_names[self.category_id]
 
     def get_show(self, window):
-        return Filters.expressions.get_show(self.get_group(), self.get_category(), window)
+        if window == -1:
+            category = Filters.expressions.registry.categories[self.category_id]
+            return category.get_show(window) if category is not None else False
+        return Filters.expressions.registry.get_show(self.category_id, window)
 
     def get_color(self):
-        return Filters.expressions.get_color(self.get_group())
+        return Filters.expressions.registry.colors[self.category_id]
 
     def print_text(self):
         print('%s' % (self.get_text(show_group=True).strip()))
         print('  Color:%s, Show:%s' % (self.get_color(), self.get_show(-1)))
+
+
+class announcement_store(object):
+    """Announcements read this session, stored column-wise: the cp437 encoded
+    text of all lines in one buffer, with parallel arrays of line offsets,
+    category ids, repeat counts and ingest timestamps.
+    history maps each category id to the ascending indices of its lines, so a
+    window can be refilled with just the categories it shows.
+    Indices count every line ever stored and are never reused. Old lines are
+    evicted from the front (see evict): base is the index of the oldest line
+    kept, and len() is the index the next line gets.
+    """
+    evict_min = 1000  # lines added between eviction passes, at least
+
+    def __init__(self, limit=None):
+        if limit is None:
+            limit = Config.settings.announcement_history_size
+        self.limit = limit  # lines kept at most, 0 for no limit
+        self.floor = 0  # lines below this index are shown nowhere (every window was cleared since)
+        self.keep = None  # lines kept per category, when every window trims its categories
+        self.clear()
+
+    def clear(self):
+        self.base = 0
+        self.text = bytearray()
+        self.offsets = array('L', [0])  # line i is text[offsets[i - base]:offsets[i - base + 1]]
+        self.category_ids = array('i')
+        self.counts = array('L')  # runs of identical lines are stored once
+        self.timestamps = array('d')
+        self.history = {}  # category id -> array of line indices
+        self.next_evict = self.evict_min
+        self.sealed = 0  # lines below this index no longer take repeats
+
+    def __len__(self):
+        return self.base + len(self.category_ids)
+
+    def __getitem__(self, index):
+        return announcement(self.get_text(index), self.get_category_id(index))
+
+    def extend(self, lines, category_ids, counts=None, timestamp=None):
+        """Append classified lines; returns the range of their indices. A first
+        line repeating the last stored one is added to that entry's count, and
+        the range then starts at that entry. The lines of the batch are never
+        evicted by this call, so the range lines up with the batch.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        if counts is None:
+            counts = [1] * len(lines)
+        start = len(self)
+        first = 0
+        if lines and len(self) > self.sealed and category_ids[0] == self.category_ids[-1] and self.get_text(-1) == lines[0]:
+            self.counts[-1] += counts[0]
+            start -= 1
+            first = 1
+        for position in range(first, len(lines)):
+            line = lines[position]
+            if type(line) is not bytes:
+                line = line.encode('cp437', 'replace')
+            self.text.extend(line)
+            self.offsets.append(len(self.text))
+            category_id = category_ids[position]
+            positions = self.history.get(category_id)
+            if positions is None:
+                positions = self.history[category_id] = array('L')
+            positions.append(len(self))
+            self.category_ids.append(category_id)
+            self.counts.append(counts[position])
+            self.timestamps.append(timestamp)
+        if len(self.category_ids) >= self.next_evict:
+            self.evict(start)
+        return range(start, len(self))
+
+    def seal(self):
+        """Store the next line as a new entry even if it repeats the last one
+        (a window was cleared below it)
+        """
+        self.sealed = len(self)
+
+    def evict(self, before=None):
+        """Drop the lines no window can show again: those below floor, those
+        beyond the newest keep lines of their category, and the oldest lines
+        past limit. Only a prefix can be freed, so a line still needed keeps the
+        lines after it. Runs every quarter of the store's size, at least every
+        evict_min lines, so the copying is spread thin. Lines from index before
+        on are kept whatever the rules say.
+        """
+        stop = max(self.floor, self.base)
+        if self.limit:
+            stop = max(stop, len(self) - self.limit)
+        if self.keep:
+            oldest = len(self)
+            for category_id in list(self.history):
+                positions = self.history[category_id]
+                if len(positions) > self.keep:
+                    del positions[:len(positions) - self.keep]
+                oldest = min(oldest, positions[0])
+            stop = max(stop, oldest)
+        stop = min(stop, len(self) - 1)  # the last line stays, for repeats of it
+        if before is not None:
+            stop = min(stop, before)
+        if stop > self.base:
+            drop = stop - self.base
+            cut = self.offsets[drop]
+            del self.text[:cut]
+            self.offsets = array('L', [offset - cut for offset in self.offsets[drop:]])
+            del self.category_ids[:drop]
+            del self.counts[:drop]
+            del self.timestamps[:drop]
+            for category_id in list(self.history):
+                positions = self.history[category_id]
+                del positions[:bisect_left(positions, stop)]
+                if not positions:
+                    del self.history[category_id]
+            self.base = stop
+        self.next_evict = len(self.category_ids) + max(len(self.category_ids) // 4, self.evict_min)
+
+    def get_text(self, index):
+        if index < 0:
+            index += len(self)
+        index -= self.base
+        return self.text[self.offsets[index]:self.offsets[index + 1]].decode('cp437')
+
+    def get_category_id(self, index):
+        return self.category_ids[index - self.base]
+
+    def get_count(self, index):
+        return self.counts[index - self.base]
+
+    def get_timestamp(self, index):
+        return self.timestamps[index - self.base]
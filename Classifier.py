@@ -0,0 +1,185 @@
+"""The combined-alternation classifier behind Filters.announcement_filter,
+and the process pool workers that run it on the backlog. This module only
+needs the standard library, so pool workers started with spawn (Windows)
+import it without loading settings or filters.txt.
+"""
+from collections import OrderedDict
+import re
+from array import array
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+class classifier(object):
+    """Combines the filter rules into a few alternations so a line is classified
+    with one or two regex calls instead of one call per rule.
+    Each rule is indexed by a required keyword pulled out of its pattern; a line
+    is only tested against the rules whose keyword it contains, plus the rules
+    without one. Branches keep the order of filters.txt, so the first matching
+    rule still wins.
+    Alternations are kept short: CPython sizes every match object by the total
+    group count, so one huge alternation is slower than a handful of small ones.
+    """
+    chunk_size = 25
+    signature_limit = 512
+    backref_format = r'\\[1-9]|\(\?P=|\(\?\('  # \N, (?P=name) and conditionals (?(1)...) / (?(name)...)
+    global_flags_format = r'\(\?[aiLmsux]+\)'  # (?i), (?x)...; scoped (?i:...) is fine
+    plain_flags = re.compile('').flags
+
+    def __init__(self, expressions, words=None, ids=None):
+        self.expressions = expressions  # category position -> compiled expressions
+        if ids is None:
+            ids = range(0, len(expressions))
+        self.ids = list(ids)  # category position -> category id
+        self.rules = []  # (category position, expression index) in match order
+        for category_id in range(0, len(expressions)):
+            for index in range(0, len(expressions[category_id])):
+                self.rules.append((category_id, index))
+        self.keywords = {}  # keyword -> rules that require it
+        self.always = []  # rules without a usable keyword
+        self.signatures = OrderedDict([])  # keywords found in a line -> chunks
+        if words is None:
+            words = [None] * len(self.rules)
+        self.words = []  # rule -> required whole-token words
+        for rule in range(0, len(self.rules)):
+            self.words.append(words[rule] if words[rule] is not None else self.rule_words(rule))
+        self.build_index()
+
+    def pattern(self, rule):
+        return self.expression(rule).pattern
+
+    def expression(self, rule):
+        category_id, index = self.rules[rule]
+        return self.expressions[category_id][index]
+
+    def rule_words(self, rule):
+        """Words every match of the rule contains as whole whitespace-separated tokens
+        """
+        expression = self.expression(rule)
+        if expression.flags & re.IGNORECASE:
+            return []
+        try:
+            items = list(sre_parse.parse(expression.pattern, expression.flags))
+        except Exception:
+            return []
+        words = []
+        literal = []
+        start = 0
+        for position in range(0, len(items) + 1):
+            if position < len(items) and items[position][0] == sre_parse.LITERAL:
+                if not literal:
+                    start = position
+                literal.append(chr(items[position][1]))
+            elif literal:
+                parts = re.split(r'\s', ''.join(literal))
+                for part in range(0, len(parts) - 1):
+                    # a part is a whole token when whitespace (or the line start) surrounds it
+                    if parts[part] and (part > 0 or start == 0):
+                        words.append(parts[part])
+                literal = []
+        return words
+
+    def build_index(self):
+        rule_words = [set(words) for words in self.words]
+        frequency = {}
+        for words in rule_words:
+            for word in words:
+                frequency[word] = frequency.get(word, 0) + 1
+        for rule in range(0, len(self.rules)):
+            if rule_words[rule]:
+                # the rarest keyword keeps the candidate lists short
+                word = min(rule_words[rule], key=lambda w: (frequency[w], -len(w)))
+                self.keywords.setdefault(word, []).append(rule)
+            else:
+                self.always.append(rule)
+
+    def signature(self, string):
+        """Keywords of the string; lines with equal signatures share their candidate rules
+        """
+        return frozenset([word for word in string.split() if word in self.keywords])
+
+    def candidates(self, signature):
+        """Return the compiled chunks for the rules that can match the signature
+        """
+        chunks = self.signatures.get(signature)
+        if chunks is None:
+            rules = set(self.always)
+            for word in signature:
+                rules.update(self.keywords[word])
+            chunks = self.build_chunks(sorted(rules))
+            if len(self.signatures) >= self.signature_limit:
+                self.signatures.popitem(last=False)
+            self.signatures[signature] = chunks
+        return chunks
+
+    def standalone(self, rule):
+        """Rules that cannot share an alternation: group references would point
+        at the wrong group, and a global inline flag would apply to every branch
+        (before Python 3.11, which rejects it)
+        """
+        pattern = self.pattern(rule)
+        return (self.expression(rule).flags != self.plain_flags
+                or re.search(self.backref_format, pattern) is not None
+                or re.search(self.global_flags_format, pattern) is not None)
+
+    def build_chunks(self, rules):
+        chunks = []  # (compiled expression, rule, {group index: rule} for alternations)
+        start = 0
+        for position in range(0, len(rules)):
+            if self.standalone(rules[position]):
+                self.add_chunk(chunks, rules[start:position])
+                chunks.append((self.expression(rules[position]), rules[position], None))
+                start = position + 1
+            elif position - start >= self.chunk_size:
+                self.add_chunk(chunks, rules[start:position])
+                start = position
+        self.add_chunk(chunks, rules[start:])
+        return chunks
+
+    def add_chunk(self, chunks, rules):
+        if not rules:
+            return
+        if len(rules) == 1:
+            chunks.append((self.expression(rules[0]), rules[0], None))
+            return
+        try:
+            # The empty group closing each branch tells which rule matched (via lastindex)
+            combined = re.compile('|'.join(['(?:%s)()' % self.pattern(rule) for rule in rules]))
+        except Exception:
+            # Inline flags, duplicate group names or group limits: split and retry
+            middle = len(rules) // 2
+            self.add_chunk(chunks, rules[:middle])
+            self.add_chunk(chunks, rules[middle:])
+            return
+        branches = {}
+        group_index = 0
+        for rule in rules:
+            group_index += self.expression(rule).groups + 1
+            branches[group_index] = rule
+        chunks.append((combined, rules[0], branches))
+
+    def match(self, string, chunks=None):
+        """Return the category id of the first matching rule, -1 if none matches
+        """
+        if chunks is None:
+            chunks = self.candidates(self.signature(string))
+        for chunk in chunks:
+            mat = chunk[0].match(string)
+            if mat:
+                if chunk[2] is None:
+                    return self.ids[self.rules[chunk[1]][0]]
+                return self.ids[self.rules[chunk[2][mat.lastindex]][0]]
+        return -1
+
+_worker_classifier = None
+
+def init_worker(table, words, ids):
+    """Process pool initializer: table is [[(pattern, flags)]] per category, in
+    match order, with the keywords of every rule already worked out
+    """
+    global _worker_classifier
+    _worker_classifier = classifier([[re.compile(pattern, flags) for pattern, flags in category] for category in table], words, ids)
+
+def classify_lines(lines):
+    return array('i', [_worker_classifier.match(line) for line in lines])
@@ -40,6 +40,10 @@ class config(object):
         self.wordcolor_path = "wordcolor.txt"
         self.gui_data = "Data/gui.dat"
         self.filters_pickle_path = "Data/filters.dat"
+        self.filters_cache_path = "Data/filters.cache"
+        self.filter_stats_path = "Data/filter_stats.txt"
+        self.gamelog_checkpoint_path = "Data/gamelog.checkpoint"
+        self.sessions_index_path = "Data/sessions.idx"
         self.icon_path = "@Data/favicon.XBM" if util.platform.linux else "Data/favicon.ico"
         self.init_var()
         self.load()
@@ -60,6 +64,10 @@ class config(object):
         self.load_previous_announcements = False
         self.save_hidden_announcements = False
         self.window_count = 2
+        self.classification_cache_size = 4096
+        self.announcement_history_size = 100000
+        self.profile_filters = False
+        self.word_color_ignore_case = False
         self.trim_announcements = [0] * self.window_count
         self.window_titles = ["Window %d" % i for i in range(self.window_count)]
         self.default_bg="#000000"
@@ -72,6 +80,10 @@ class config(object):
             self.parser.set("Settings", 'save_hidden_announcements', str(self.save_hidden_announcements))
             self.parser.set("Settings", 'load_previous_announcements', str(self.load_previous_announcements))
             self.parser.set("Settings", 'window_count', str(self.window_count))
+            self.parser.set("Settings", 'classification_cache_size', str(self.classification_cache_size))
+            self.parser.set("Settings", 'announcement_history_size', str(self.announcement_history_size))
+            self.parser.set("Settings", 'profile_filters', str(self.profile_filters))
+            self.parser.set("Settings", 'word_color_ignore_case', str(self.word_color_ignore_case))
             for i in range(self.window_count):
                 self.parser.set("Settings", 'trim_announcements_%d' % i, str(self.trim_announcements[i]))
                 self.parser.set("Settings", 'window_title_%d' % i, str(self.window_titles[i]))
@@ -91,6 +103,26 @@ class config(object):
             except:
                 self.window_count = 2
 
+            try:
+                self.classification_cache_size = self.parser.getint("Settings", 'classification_cache_size')
+            except:
+                self.classification_cache_size = 4096
+
+            try:
+                self.announcement_history_size = self.parser.getint("Settings", 'announcement_history_size')
+            except:
+                self.announcement_history_size = 100000
+
+            try:
+                self.profile_filters = self.parser.getboolean("Settings", 'profile_filters')
+            except:
+                self.profile_filters = False
+
+            try:
+                self.word_color_ignore_case = self.parser.getboolean("Settings", 'word_color_ignore_case')
+            except:
+                self.word_color_ignore_case = False
+
             self.trim_announcements = []
             self.window_titles = []
             for i in range(self.window_count):
@@ -0,0 +1,198 @@
+"""Static analysis of filters.txt.
+
+Usage: python FilterAnalyzer.py [gamelog ...]
+
+Loads the rules through Filters.announcement_filter.load_filter_expressions and
+reports:
+  - duplicated patterns (the later copy can never match first),
+  - shadowed rules: given a corpus of real gamelog lines, rules that match some
+    lines but never win because an earlier rule catches all of them,
+  - backtracking candidates: every regex is timed against synthetic near-miss
+    inputs of growing length; rules whose match time grows much faster than
+    the input, or is slow outright, are flagged.
+
+Rules are checked in the order the program tries them: groups and categories in
+order of first appearance in filters.txt, then expressions within a category.
+"""
+import sys
+import io
+import math
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+import Filters
+
+timer = Filters.timer
+
+BENCH_LENGTHS = (100, 200, 400)
+BENCH_REPEAT = 3
+SLOW_MATCH_MS = 5.0       # flag any rule slower than this on the longest input
+GROWTH_EXPONENT = 2.5     # flag t ~ n**k growth with k above this...
+GROWTH_MIN_MS = 0.1       # ...once the match takes long enough to time reliably
+
+
+def load_rules(expressions=None):
+    """(group, category, expression index, compiled expression) in match order
+    """
+    if expressions is None:
+        expressions = Filters.expressions
+    expressions.load_filter_expressions()
+    rules = []
+    for position in range(0, len(expressions.category_list)):
+        cat = expressions.category_list[position]
+        group = expressions.registry.groups[expressions.category_ids[position]]
+        for index in range(0, len(cat.re_expressions)):
+            rules.append((group.group, cat.category, index, cat.re_expressions[index]))
+    return rules
+
+
+def rule_name(rule):
+    return '[%s][%s] "%s"' % (rule[0], rule[1], rule[3].pattern)
+
+
+def read_corpus(paths):
+    lines = {}
+    for path in paths:
+        with io.open(path, 'r', encoding='cp437') as fi:
+            for line in fi:
+                line = line.strip()
+                if line:
+                    lines[line] = lines.get(line, 0) + 1
+    return lines
+
+
+def find_duplicates(rules):
+    seen = {}
+    duplicates = []
+    for rule in range(0, len(rules)):
+        pattern = rules[rule][3].pattern
+        if pattern in seen:
+            duplicates.append((rule, seen[pattern]))
+        else:
+            seen[pattern] = rule
+    return duplicates
+
+
+def find_shadowed(rules, corpus):
+    """Returns (wins, matches, shadowed_by) where shadowed_by maps a rule to
+    {earlier winning rule: line count} for every line it matched but lost.
+    """
+    wins = [0] * len(rules)
+    matches = [0] * len(rules)
+    shadowed_by = {}
+    for line, count in corpus.items():
+        winner = None
+        for rule in range(0, len(rules)):
+            if rules[rule][3].match(line):
+                matches[rule] += count
+                if winner is None:
+                    winner = rule
+                    wins[rule] += count
+                else:
+                    losses = shadowed_by.setdefault(rule, {})
+                    losses[winner] = losses.get(winner, 0) + count
+    return wins, matches, shadowed_by
+
+
+def literal_fragments(pattern):
+    """Top-level literal runs of the pattern, None in place of everything else
+    """
+    fragments = []
+    literal = []
+    for op, av in sre_parse.parse(pattern):
+        if op == sre_parse.LITERAL:
+            literal.append(chr(av))
+        else:
+            if literal:
+                fragments.append(''.join(literal))
+                literal = []
+            if not fragments or fragments[-1] is not None:
+                fragments.append(None)
+    if literal:
+        fragments.append(''.join(literal))
+    return fragments
+
+
+def near_miss(pattern, length):
+    """A line that follows the pattern's literals but cannot complete a match:
+    the variable parts are filled with repeats of the separators (the input that
+    makes adjacent wildcards fight over every split), and the final literal is
+    left off.
+    """
+    fragments = literal_fragments(pattern)
+    prefix = fragments[0] if fragments and fragments[0] is not None else ''
+    if fragments and fragments[-1] is not None and len(fragments) > 1:
+        fragments = fragments[:-1]
+    separators = ''.join([f for f in fragments[1:] if f is not None]) or ' '
+    filler = ''
+    while len(prefix) + len(filler) < length:
+        filler += 'a' + separators
+    return prefix + filler[:max(length - len(prefix), 0)]
+
+
+def time_match(expression, string):
+    best = None
+    for repeat in range(0, BENCH_REPEAT):
+        start = timer()
+        expression.match(string)
+        elapsed = timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def benchmark(rules):
+    """(rule, milliseconds at the longest input, growth exponent) for every rule
+    """
+    results = []
+    for rule in range(0, len(rules)):
+        expression = rules[rule][3]
+        try:
+            times = [time_match(expression, near_miss(expression.pattern, n)) for n in BENCH_LENGTHS]
+        except Exception:
+            continue
+        exponent = 0.0
+        if times[-2] > 0 and times[-1] > 0:
+            exponent = math.log(times[-1] / times[-2]) / math.log(float(BENCH_LENGTHS[-1]) / BENCH_LENGTHS[-2])
+        results.append((rule, times[-1] * 1000, exponent))
+    return results
+
+
+def report(rules, corpus=None, out=sys.stdout):
+    out.write('%d rules loaded\n' % len(rules))
+
+    duplicates = find_duplicates(rules)
+    out.write('\nDuplicated patterns (%d):\n' % len(duplicates))
+    for rule, first in duplicates:
+        out.write('  %s\n    already matched by %s\n' % (rule_name(rules[rule]), rule_name(rules[first])))
+
+    if corpus:
+        wins, matches, shadowed_by = find_shadowed(rules, corpus)
+        shadowed = [rule for rule in range(0, len(rules)) if matches[rule] and not wins[rule]]
+        out.write('\nShadowed rules: match corpus lines but never win (%d):\n' % len(shadowed))
+        for rule in shadowed:
+            out.write('  %s (%d lines)\n' % (rule_name(rules[rule]), matches[rule]))
+            winners = sorted(shadowed_by[rule].items(), key=lambda item: -item[1])
+            for winner, count in winners[:3]:
+                out.write('    caught by %s (%d)\n' % (rule_name(rules[winner]), count))
+        unmatched = [rule for rule in range(0, len(rules)) if not matches[rule]]
+        out.write('\nRules matching no corpus line (%d of %d, %d distinct lines):\n' % (len(unmatched), len(rules), len(corpus)))
+        for rule in unmatched:
+            out.write('  %s\n' % rule_name(rules[rule]))
+
+    results = benchmark(rules)
+    flagged = [result for result in results
+               if result[1] > SLOW_MATCH_MS or (result[2] > GROWTH_EXPONENT and result[1] > GROWTH_MIN_MS)]
+    flagged.sort(key=lambda result: -result[1])
+    out.write('\nBacktracking candidates (%d): time on a %d character near-miss, growth exponent\n' % (len(flagged), BENCH_LENGTHS[-1]))
+    for rule, milliseconds, exponent in flagged:
+        out.write('  %9.3f ms  n^%.1f  %s\n' % (milliseconds, exponent, rule_name(rules[rule])))
+    out.write('\nSlowest rules on near-miss input:\n')
+    for rule, milliseconds, exponent in sorted(results, key=lambda result: -result[1])[:10]:
+        out.write('  %9.3f ms  n^%.1f  %s\n' % (milliseconds, exponent, rule_name(rules[rule])))
+
+
+if __name__ == "__main__":
+    report(load_rules(), read_corpus(sys.argv[1:]))
@@ -4,11 +4,53 @@ import pickle
 import Config
 import sys
 import json
+import hashlib
+import time
+import multiprocessing
+import threading
+from array import array
+import Classifier
+from Classifier import classifier
+
+FILTER_CACHE_VERSION = 2
+timer = getattr(time, 'perf_counter', time.time)
+
+class cached_expression(object):
+    """Stands in for a rule restored from the filter cache; the pattern is only
+    compiled the first time it is used on its own. Everything but pattern,
+    flags and groups comes from the compiled pattern.
+    """
+    def __init__(self, pattern, flags, groups):
+        self.pattern = pattern
+        self.flags = flags
+        self.groups = groups
+        self.compiled = None
+
+    def compile(self):
+        if self.compiled is None:
+            self.compiled = re.compile(self.pattern, self.flags)
+        return self.compiled
+
+    def match(self, string, *args):
+        return self.compile().match(string, *args)
+
+    def __getattr__(self, name):
+        # only called for attributes not set above (search, sub, groupindex...)
+        if name == 'compiled':
+            raise AttributeError(name)
+        return getattr(self.compile(), name)
+
+def compile_expression(re_expression):
+    if isinstance(re_expression, cached_expression):
+        return re_expression
+    return re.compile(re_expression)
 
 class subgroup(object):
     def __init__(self, category, re_expression, w, show):
         self.category = category
-        self.re_expressions = [re.compile(re_expression)]
+        self.re_expressions = [compile_expression(re_expression)]
+        self.hits = [0]  # per expression, only recorded while profiling
+        self.match_time = [0.0]
         self.show = OrderedDict([])
         self.show[w] = show
 
@@ -32,7 +74,9 @@ class subgroup(object):
         self.show[w] = self.show[0]
 
     def add_expression(self, re_expression):
-        self.re_expressions.append(re.compile(re_expression))
+        self.re_expressions.append(compile_expression(re_expression))
+        self.hits.append(0)
+        self.match_time.append(0.0)
 
     def check_expression(self, string):
         for expression in self.re_expressions:
@@ -40,6 +84,22 @@ class subgroup(object):
                 return True
         return False
 
+    def profile_expression(self, string):
+        """check_expression that records hits and match time per expression
+        """
+        for index in range(0, len(self.re_expressions)):
+            start = timer()
+            mat = self.re_expressions[index].match(string)
+            self.match_time[index] += timer() - start
+            if mat:
+                self.hits[index] += 1
+                return True
+        return False
+
+    def reset_stats(self):
+        self.hits = [0] * len(self.re_expressions)
+        self.match_time = [0.0] * len(self.re_expressions)
+
     def get_rematch(self, string):
         for expression in self.re_expressions:
             e = expression.match(string)
@@ -97,24 +157,380 @@ class groups(object):
             ret_dict['categories'][cat_[0]] = cat_[1]._dict()
         return ret_dict
 
+def pool_context():
+    """Start pool workers with spawn where the choice exists: a forked child
+    inherits the locks other threads (the gamelog reader, the session indexer)
+    hold at that moment and can deadlock on them. Python 2 only forks, so the
+    pool is created while the filter lock is held and the caller holds the
+    reader's and session index's locks (see main_gui.load_backlog).
+    """
+    get_context = getattr(multiprocessing, 'get_context', None)
+    if get_context is None:
+        return multiprocessing
+    return get_context('spawn')
+
+class parallel_classifier(object):
+    """Classifies a long list of lines (the announcement backlog) in line-aligned
+    chunks spread over a process pool. Every worker compiles the rule table
+    once, in the pool initializer (see Classifier.init_worker). Finished chunks
+    are handed out in order, so the caller can display them while the rest is
+    still being classified.
+    Small backlogs, or platforms where the pool cannot start, are classified
+    in-process one chunk per call instead.
+    """
+    chunk_lines = 5000
+
+    def __init__(self, filter_, lines):
+        self.filter = filter_
+        self.chunks = [lines[start:start + self.chunk_lines] for start in range(0, len(lines), self.chunk_lines)]
+        self.results = []
+        self.pool = None
+        if len(self.chunks) > 1 and not filter_.profiling:
+            with filter_.lock:
+                table = [[(exp.pattern, exp.flags) for exp in cat.re_expressions] for cat in filter_.category_list]
+                words = filter_.get_classifier().words
+                ids = list(filter_.category_ids)
+                try:
+                    self.pool = pool_context().Pool(min(len(self.chunks), multiprocessing.cpu_count()),
+                                                     initializer=Classifier.init_worker, initargs=(table, words, ids))
+                    for chunk in self.chunks:
+                        self.results.append(self.pool.apply_async(Classifier.classify_lines, (chunk,)))
+                    self.pool.close()
+                except Exception as ex:
+                    print("Warning: backlog process pool unavailable, classifying in-process: %s" % ex)
+                    if self.pool is not None:
+                        self.pool.terminate()
+                        self.pool.join()
+                    self.pool = None
+                    self.results = []
+
+    def done(self):
+        if self.chunks:
+            return False
+        if self.pool is not None:
+            self.pool.join()  # the workers have exited once every chunk is in
+            self.pool = None
+        return True
+
+    def ready_chunks(self):
+        """Yield (lines, category ids) for each finished chunk, oldest first
+        """
+        while self.chunks:
+            if self.pool is None:
+                category_ids = self.filter.classify_many(self.chunks[0])[1]
+            elif self.results[0].ready():
+                try:
+                    category_ids = self.results.pop(0).get()
+                except Exception as ex:
+                    print("Warning: backlog worker failed, classifying in-process: %s" % ex)
+                    category_ids = self.filter.classify_many(self.chunks[0])[1]
+            else:
+                return
+            yield self.chunks.pop(0), category_ids
+            if self.pool is None:
+                return  # keep the caller responsive: one chunk per call
+
+    def terminate(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        self.chunks = []
+        self.results = []
+
+class category_registry(object):
+    """Gives every (group, category) pair seen since startup a small integer id.
+    Ids are never reused or renumbered, so announcements can carry just the id
+    across filter reloads. The strings the renderer needs (tag names, the
+    [group][category] prefix, the group color) and the per-window visibility are
+    precomputed per id.
+    """
+    def __init__(self):
+        self.ids = {}  # (group name, category name) -> category id
+        self.group_ids = {}  # group name -> group id
+        self.category_groups = array('i')  # category id -> group id
+        self.groups = []  # category id -> groups, None once removed from filters.txt
+        self.categories = []  # category id -> subgroup, None once removed
+        self.group_names = []
+        self.category_names = []
+        self.tag_names = []  # "group.category"
+        self.elide_tag_names = []  # "group.category.elide"
+        self.prefixes = []  # "[group][category] "
+        self.colors = []
+        self.shows = []  # window -> bytearray of visibility by category id
+
+    def __len__(self):
+        return len(self.categories)
+
+    def intern(self, group, category):
+        key = (group.group, category.category)
+        category_id = self.ids.get(key)
+        if category_id is None:
+            category_id = len(self.categories)
+            self.ids[key] = category_id
+            self.category_groups.append(self.group_ids.setdefault(group.group, len(self.group_ids)))
+            self.groups.append(group)
+            self.categories.append(category)
+            self.group_names.append(group.group)
+            self.category_names.append(category.category)
+            self.tag_names.append("%s.%s" % key)
+            self.elide_tag_names.append("%s.%s.elide" % key)
+            self.prefixes.append("[%s][%s] " % key)
+            self.colors.append(group.color)
+        else:
+            self.groups[category_id] = group
+            self.categories[category_id] = category
+        return category_id
+
+    def retire(self, active):
+        """Detach the ids of categories that are no longer in filters.txt
+        """
+        for category_id in range(0, len(self.categories)):
+            if category_id not in active:
+                self.groups[category_id] = None
+                self.categories[category_id] = None
+
+    def refresh(self, window_count):
+        """Recompute colors and visibility after groups or show states changed
+        """
+        self.shows = [bytearray(len(self.categories)) for window in range(0, window_count)]
+        for category_id in range(0, len(self.categories)):
+            category = self.categories[category_id]
+            if category is None:
+                continue
+            self.colors[category_id] = self.groups[category_id].color
+            for window in range(0, window_count):
+                if category.get_show(window):
+                    self.shows[window][category_id] = 1
+
+    def get_show(self, category_id, window):
+        if 0 <= window < len(self.shows) and 0 <= category_id < len(self.categories):
+            return self.shows[window][category_id] == 1
+        return False
+
+class classification_cache(object):
+    """Bounded LRU map from announcement text to its category id
+    """
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict([])
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, string):
+        entry = self.entries.pop(string, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries[string] = entry  # most recently used goes last
+        self.hits += 1
+        return entry
+
+    def put(self, string, entry):
+        if self.size <= 0:
+            return
+        while len(self.entries) >= self.size:
+            self.entries.popitem(last=False)
+        self.entries[string] = entry
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def resize(self, size):
+        self.size = size
+        while len(self.entries) > max(self.size, 0):
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return 'cache: %d/%d entries, %d hits, %d misses (%.1f%% hit rate)' % (
+            len(self.entries), self.size, self.hits, self.misses, 100.0 * self.hits / total if total else 0.0)
+
 class announcement_filter(object):
     def __init__(self):
         self.groups = OrderedDict([])
         self.pickle_path = Config.settings.filters_pickle_path
         self.filters_path = Config.settings.filters_path
+        self.filters_cache_path = Config.settings.filters_cache_path
         self.filter_format = '\[(?P<group>\w+)\]\[(?P<category>\w+|\s*)\]\s*\"(?P<expression>.+)\"'
         self.window_count = Config.settings.window_count
+        self.profiling = Config.settings.profile_filters
+        self.registry = category_registry()
+        self.category_list = []  # categories in match order
+        self.category_ids = array('i')  # match order position -> category id
+        self.classifier = None
+        self.rule_words = {}  # pattern -> required keywords, see classifier.rule_words
+        self.cache = classification_cache(Config.settings.classification_cache_size)
+        self.lock = threading.RLock()  # held while rules change or a batch is classified
         self.reload()
 
     def reload(self):
-        self.load_filter_expressions()
-        self.load_filter_data()
+        """Bring the rules and window visibility in line with filters.txt and
+        filters.dat. Only what differs from the loaded state is touched: unchanged
+        rules keep their compiled patterns and statistics, and the classifier and
+        classification cache stay warm unless a rule changed.
+        Returns the set of windows whose visibility changed.
+        """
+        with self.lock:
+            self.cache.resize(Config.settings.classification_cache_size)
+            key = self.filter_cache_key()
+            table = self.load_filter_cache(key)
+            if table is not None:
+                return self.apply_filter_table(table)
+            changed = self.apply_filter_table(self.read_filter_table())
+            self.save_filter_cache(key)
+            return changed
+
+    def filter_cache_key(self):
+        """Identifies the filters.txt/filters.dat contents the cache was built from
+        """
+        key = [self.window_count]
+        for path in (self.filters_path, self.pickle_path):
+            if os.path.isfile(path):
+                with open(path, 'rb') as fi:
+                    key.append((os.path.getmtime(path), hashlib.sha1(fi.read()).hexdigest()))
+            else:
+                key.append(None)
+        return key
+
+    def load_filter_cache(self, key):
+        """Return the filter table stored in the cache, None when it is stale
+        """
+        try:
+            with open(self.filters_cache_path, 'rb') as fi:
+                data = pickle.load(fi)
+            if data['version'] != FILTER_CACHE_VERSION or data['key'] != key:
+                return None
+        except Exception:
+            return None
+        table = []
+        for group_name, color, categories in data['groups']:
+            table.append((group_name, color, [(category_name, show, [cached_expression(*exp) for exp in expressions])
+                                              for category_name, show, expressions in categories]))
+        self.rule_words.update(data['words'])
+        return table
+
+    def save_filter_cache(self, key):
+        self.get_classifier()  # fills rule_words
+        table = []
+        for group in self.groups.items():
+            categories = []
+            for cat in group[1].categories.items():
+                expressions = [(exp.pattern, exp.flags, exp.groups) for exp in cat[1].re_expressions]
+                categories.append((cat[0], list(cat[1].show.items()), expressions))
+            table.append((group[0], group[1].color, categories))
+        data = {'version': FILTER_CACHE_VERSION, 'key': key, 'groups': table, 'words': self.rule_words}
+        try:
+            with open(self.filters_cache_path, 'wb') as fi:
+                pickle.dump(data, fi, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as ex:
+            print("Warning: could not write filter cache: %s" % ex)
+
+    def read_filter_table(self):
+        """Parse filters.txt and filters.dat into
+        [(group, color, [(category, [(window, show)], [pattern])])]
+        """
+        data = self.read_filter_data()
+        table = []
+        for group_name, categories in self.read_filter_expressions().items():
+            color = "#FF0" if group_name == "UNKNOWN" else "#FFF"
+            group_data = data.get(group_name, {}).get('categories', {})
+            category_table = []
+            for category_name, patterns in categories.items():
+                show = OrderedDict([(0, True)])
+                for window in range(0, self.window_count):
+                    show[window] = True
+                if category_name in group_data:
+                    for window in range(0, self.window_count):
+                        if str(window) in group_data[category_name]["show"]:
+                            show[window] = group_data[category_name]["show"][str(window)]
+                    color = data[group_name]['color']
+                category_table.append((category_name, list(show.items()), patterns))
+            table.append((group_name, color, category_table))
+        return table
+
+    def apply_filter_table(self, table):
+        """Update the loaded groups to match a filter table; returns the windows
+        whose visibility changed
+        """
+        loaded = [(group.group, [(cat.category, [exp.pattern for exp in cat.re_expressions])
+                                 for cat in group.categories.values()]) for group in self.groups.values()]
+        wanted = [(group_name, [(category_name, [getattr(exp, 'pattern', exp) for exp in expressions])
+                                for category_name, show, expressions in categories]) for group_name, color, categories in table]
+        shows = self.registry.shows
+        if loaded != wanted:
+            self.rebuild_rules(table)
+        for group_name, color, categories in table:
+            group = self.groups[group_name]
+            if group.color != color:
+                group.set_color(color)
+            for category_name, show, expressions in categories:
+                cat = group.categories[category_name]
+                for window, value in show:
+                    if cat.show.get(window) != value:
+                        cat.show[window] = value
+        self.registry.refresh(self.window_count)
+        # Compare against the visibility the windows were last built with; this
+        # also catches show states edited in memory (TagConfig) before saving.
+        changed = set()
+        for window in range(0, self.window_count):
+            new = self.registry.shows[window]
+            if window >= len(shows) or shows[window].ljust(len(new), b'\0') != new:
+                changed.add(window)
+        return changed
+
+    def rebuild_rules(self, table):
+        """Rebuild the group/category structure, reusing the compiled pattern of
+        every rule whose text did not change
+        """
+        old_expressions = {}
+        for cat in self.category_list:
+            for exp in cat.re_expressions:
+                old_expressions.setdefault(exp.pattern, exp)
+        new_groups = OrderedDict([])
+        for group_name, color, categories in table:
+            group = self.groups.get(group_name)
+            if group is None:
+                group = groups(group_name)
+                group.set_color(color)
+            old_categories = group.categories
+            group.categories = OrderedDict([])
+            for category_name, show, expressions in categories:
+                compiled = []
+                for exp in expressions:
+                    compiled.append(old_expressions.get(getattr(exp, 'pattern', exp)) or compile_expression(exp))
+                cat = old_categories.get(category_name)
+                if cat is None:
+                    cat = subgroup(category_name, compiled[0], 0, True)
+                    cat.show = OrderedDict(show)
+                    for exp in compiled[1:]:
+                        cat.add_expression(exp)
+                elif [exp.pattern for exp in cat.re_expressions] != [exp.pattern for exp in compiled]:
+                    cat.re_expressions = compiled
+                    cat.reset_stats()
+                group.categories[category_name] = cat
+            new_groups[group_name] = group
+        self.groups.clear()
+        self.groups.update(new_groups)
+        self.index_categories()
+        self.invalidate()
 
     def lookup_group(self, group):
         return self.groups.get(group)
 
-    def load_filter_expressions(self):
-        self.groups.clear()
+    def invalidate(self):
+        """Drop derived matching structures after the rule set was changed
+        """
+        with self.lock:
+            self.classifier = None
+            self.cache.clear()
+
+    def read_filter_expressions(self):
+        """Parse filters.txt into {group: {category: [pattern]}}, UNKNOWN last
+        """
+        rules = OrderedDict([])
         if os.path.isfile(self.filters_path):
             with open(self.filters_path, 'r') as fi:
                 for line in fi:
@@ -126,47 +542,176 @@ class announcement_filter(object):
                             expression = mat.group("expression")
                             if category == "" or category == None:
                                 category = "Other/All"
-                            if not self.lookup_group(group):
-                                self.groups[group] = groups(group)
-                            self.lookup_group(group).add_category(category, expression)
-        group = "UNKNOWN"
-        category = "unmatchedString"
-        expression = "(.+)"
-        self.groups[group] = groups(group)
-        self.groups[group].set_color("#FF0")
-        self.lookup_group(group).add_category(category, expression)
+                            rules.setdefault(group, OrderedDict([])).setdefault(category, []).append(expression)
+        rules["UNKNOWN"] = OrderedDict([("unmatchedString", ["(.+)"])])
+        return rules
+
+    def read_filter_data(self):
+        if os.path.isfile(self.pickle_path):
+            with open(self.pickle_path, 'r') as fi:
+                return json.load(fi, parse_int=True)
+        return {}
+
+    def load_filter_expressions(self):
+        self.groups.clear()
+        self.invalidate()
+        for group_name, categories in self.read_filter_expressions().items():
+            self.groups[group_name] = groups(group_name)
+            for category, expressions in categories.items():
+                for expression in expressions:
+                    self.groups[group_name].add_category(category, expression)
+        self.groups["UNKNOWN"].set_color("#FF0")
         if self.window_count > 0:
             for window in range(0, self.window_count):
                 for group in self.groups.items():
                     for cat in group[1].categories.items():
                         cat[1].add_window(window)
+        self.index_categories()
+
+    def index_categories(self):
+        """List the categories in match order and intern their ids
+        """
+        del self.category_list[:]
+        self.category_ids = array('i')
+        for group in self.groups.items():
+            for cat in group[1].categories.items():
+                self.category_list.append(cat[1])
+                self.category_ids.append(self.registry.intern(group[1], cat[1]))
+        self.registry.retire(set(self.category_ids))
+        self.registry.refresh(self.window_count)
 
     def load_filter_data(self):
-        if os.path.isfile(self.pickle_path):
-            with open(self.pickle_path, 'r') as fi:
-                groups_temp = json.load(fi, parse_int=True)
-                for window in range(0, self.window_count):
-                    for group in groups_temp.items():
-                        g = self.lookup_group(group[0])
-                        if g:
-                            for cat in group[1]['categories'].items():
-                                c = g.lookup_category(cat[0])
-                                if c:
-                                    if str(window) in cat[1]["show"]:
-                                        g.set_show(cat[0], window, cat[1]["show"][str(window)])
-                                    g.set_color(group[1]['color'])
+        groups_temp = self.read_filter_data()
+        for window in range(0, self.window_count):
+            for group in groups_temp.items():
+                g = self.lookup_group(group[0])
+                if g:
+                    for cat in group[1]['categories'].items():
+                        c = g.lookup_category(cat[0])
+                        if c:
+                            if str(window) in cat[1]["show"]:
+                                g.set_show(cat[0], window, cat[1]["show"][str(window)])
+                            g.set_color(group[1]['color'])
+        self.registry.refresh(self.window_count)
 
 
     def save_filter_data(self):
         with open(self.pickle_path, 'w') as fi:
             json.dump(self._dict(), fi, indent=4)
 
+    def get_classifier(self):
+        if self.classifier is None:
+            expressions = [cat.re_expressions for cat in self.category_list]
+            patterns = [exp.pattern for category in expressions for exp in category]
+            self.classifier = classifier(expressions, [self.rule_words.get(pattern) for pattern in patterns], self.category_ids)
+            self.rule_words = dict(zip(patterns, self.classifier.words))
+        return self.classifier
+
+    def find_category_id(self, string):
+        if self.profiling:
+            return self.profile_category_id(string)
+        category_id = self.cache.get(string)
+        if category_id is None:
+            category_id = self.get_classifier().match(string)
+            self.cache.put(string, category_id)
+        return category_id
+
+    def profile_category_id(self, string):
+        """Rule by rule classification that records per-expression statistics
+        """
+        for position in range(0, len(self.category_list)):
+            if self.category_list[position].profile_expression(string):
+                return self.category_ids[position]
+        return -1
+
+    def set_profiling(self, profiling):
+        self.profiling = profiling
+
+    def reset_stats(self):
+        for cat in self.category_list:
+            cat.reset_stats()
+
+    def rule_stats(self):
+        """(group, category, expression index, pattern, hits, seconds) for every rule
+        """
+        stats = []
+        for position in range(0, len(self.category_list)):
+            cat = self.category_list[position]
+            group = self.registry.groups[self.category_ids[position]]
+            for index in range(0, len(cat.re_expressions)):
+                stats.append((group.group, cat.category, index, cat.re_expressions[index].pattern,
+                              cat.hits[index], cat.match_time[index]))
+        return stats
+
+    def stats_report(self, limit=20):
+        stats = self.rule_stats()
+        lines = ['Filter statistics (%d rules, %d matches)' % (len(stats), sum([rule[4] for rule in stats]))]
+        sections = [('Hottest rules', sorted([rule for rule in stats if rule[4]], key=lambda rule: -rule[4])[:limit]),
+                    ('Slowest rules', sorted(stats, key=lambda rule: -rule[5])[:limit]),
+                    ('Never matched', [rule for rule in stats if rule[4] == 0])]
+        for title, rules in sections:
+            lines.append('')
+            lines.append('%s:' % title)
+            for group, category, index, pattern, hits, seconds in rules:
+                lines.append('  %8d hits %10.3f ms  [%s][%s] "%s"' % (hits, seconds * 1000, group, category, pattern))
+        return '\n'.join(lines) + '\n'
+
+    def print_filter_stats(self):
+        print(self.stats_report())
+
+    def save_filter_stats(self, path=None):
+        if path is None:
+            path = Config.settings.filter_stats_path
+        with open(path, 'w') as fi:
+            fi.write(self.stats_report(limit=len(self.rule_stats())))
+
+    def lookup_category_id(self, category_id):
+        if category_id < 0:
+            return None, None
+        return self.registry.groups[category_id], self.registry.categories[category_id]
+
     def find_expression(self, string):
-        for group in self.groups.items():
-            cat = group[1].find_expression(string)
-            if cat:
-                return group[1], cat
-        return None, None
+        return self.lookup_category_id(self.find_category_id(string))
+
+    def classify_many(self, lines):
+        """Classify a batch of lines at once.
+        Returns parallel arrays of group ids and category ids (see
+        category_registry, -1 where nothing matched). Repeated lines
+        are classified once and lines sharing a keyword signature share one
+        candidate lookup.
+        """
+        with self.lock:
+            group_ids = array('i', [-1]) * len(lines)
+            category_ids = array('i', [-1]) * len(lines)
+            if self.profiling:
+                for position in range(0, len(lines)):
+                    category_ids[position] = self.profile_category_id(lines[position])
+                    if category_ids[position] >= 0:
+                        group_ids[position] = self.registry.category_groups[category_ids[position]]
+                return group_ids, category_ids
+            positions = OrderedDict([])  # line -> positions in the batch
+            for position in range(0, len(lines)):
+                positions.setdefault(lines[position], []).append(position)
+            classifier_ = self.get_classifier()
+            by_signature = OrderedDict([])  # signature -> uncached lines
+            for line in positions:
+                category_id = self.cache.get(line)
+                if category_id is None:
+                    by_signature.setdefault(classifier_.signature(line), []).append(line)
+                else:
+                    for position in positions[line]:
+                        category_ids[position] = category_id
+            for signature, signature_lines in by_signature.items():
+                chunks = classifier_.candidates(signature)
+                for line in signature_lines:
+                    category_id = classifier_.match(line, chunks)
+                    self.cache.put(line, category_id)
+                    for position in positions[line]:
+                        category_ids[position] = category_id
+            for position in range(0, len(lines)):
+                if category_ids[position] >= 0:
+                    group_ids[position] = self.registry.category_groups[category_ids[position]]
+            return group_ids, category_ids
 
     def add_window(self, window):
         if window >= self.window_count:
@@ -174,6 +719,7 @@ class announcement_filter(object):
         for group in self.groups.items():
             for cat in group[1].categories.items():
                 cat[1].add_window(window)
+        self.registry.refresh(self.window_count)
 
     def print_filters(self):
         for group in self.groups.items():
@@ -184,6 +730,7 @@ class announcement_filter(object):
                 print('   patterns:')
                 for exp in cat[1].re_expressions:
                     print('    %s' % exp.pattern)
+        print(self.cache.stats())
     def set_color(self, group, color):
         g = self.lookup_group(group)
         if g:
@@ -1,50 +1,587 @@
 import Config
+import Filters
 import os, io
-from Announcements import announcement
-import re
+import codecs
+import mmap
+import pickle
+import hashlib
+import time
+import sys
+import ctypes
+import ctypes.util
+import select
+import threading
+if sys.version_info.major == 2:
+    import Queue as queue
+else:
+    import queue
+from Announcements import announcement_store
+import WordColor
+import util
+from array import array
+
+timer = Filters.timer
+
+POLL_MIN = 0.1  # seconds between gamelog stats right after new lines were read...
+POLL_MAX = 1.0  # ...backing off to this while nothing is written
+POLL_WATCHED = 5.0  # safety net when inotify wakes us up on writes
+READ_BATCH = 200  # lines per queued batch
+READ_CHUNK = 1 << 20  # bytes per read from the gamelog
+SESSION_MARKER = b'** Loading Fortress **'
+CHECKPOINT_INTERVAL = 10.0  # seconds between saves of the read offset while tailing
+FINGERPRINT_BYTES = 1024  # bytes hashed at the start of the file and before the offset
+SESSION_INDEX_VERSION = 1
+
+class inotify_watcher(object):
+    """Linux inotify watch on a single file, opened through ctypes. fileno() is
+    readable whenever the file was written to, so the Tk loop can sleep on it.
+    """
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_CLOEXEC = 0o2000000
+    IN_NONBLOCK = 0o4000
+
+    def __init__(self, path):
+        self.fd = -1
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        mask = self.IN_MODIFY | self.IN_ATTRIB | self.IN_DELETE_SELF | self.IN_MOVE_SELF
+        if libc.inotify_add_watch(fd, path.encode(sys.getfilesystemencoding()), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(errno, "inotify_add_watch failed")
+        self.fd = fd
+
+    def fileno(self):
+        return self.fd
+
+    def drain(self):
+        """Discard the pending events; returns True if there were any
+        """
+        events = False
+        while True:
+            try:
+                data = os.read(self.fd, 4096)
+            except OSError:
+                break  # EAGAIN: nothing left to read
+            if not data:
+                break
+            events = True
+        return events
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+def watch_file(path):
+    """An inotify_watcher for path, or None where inotify is not available
+    """
+    if not util.platform.linux:
+        return None
+    try:
+        return inotify_watcher(path)
+    except (OSError, AttributeError) as ex:
+        print("Warning: inotify unavailable, polling the gamelog instead: %s" % ex)
+        return None
+
+class session_index(object):
+    """Where every fortress session starts in the gamelog: the byte offset and
+    line number of each "** Loading Fortress **" line, with the times the index
+    first and last saw the session (the gamelog itself has no timestamps).
+    Kept in Data/sessions.idx and extended from where it stopped, so the file
+    is scanned once. The scan runs in a background thread (start_update); the
+    lists can be read while it is in progress.
+    """
+    def __init__(self):
+        self.index_path = Config.settings.sessions_index_path
+        self.path = None  # gamelog the index belongs to
+        self.head = None  # hash of the gamelog's first bytes, to notice replacement
+        self.indexed = 0  # bytes covered, always just after a newline
+        self.lines = 0  # lines in the covered bytes
+        self.sessions = []  # [offset, line number, first seen, last seen]
+        self.lock = threading.RLock()  # held while the index changes or is read
+        self.updating = threading.Lock()  # held by the one thread scanning the gamelog
+        self.updater = None
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.index_path, 'rb') as fi:
+                data = pickle.load(fi)
+            if data["version"] == SESSION_INDEX_VERSION:
+                self.path, self.head, self.indexed, self.lines, self.sessions = data["index"]
+        except Exception:
+            pass
+
+    def save(self):
+        try:
+            with open(self.index_path, 'wb') as fo:
+                pickle.dump({"version": SESSION_INDEX_VERSION,
+                             "index": (self.path, self.head, self.indexed, self.lines, self.sessions)}, fo, protocol=0)
+        except (IOError, OSError) as ex:
+            print("Warning: could not save the session index: %s" % ex)
+
+    def head_hash(self, fi, length):
+        fi.seek(0)
+        return hashlib.sha1(fi.read(min(length, FINGERPRINT_BYTES))).hexdigest()
+
+    def start_update(self, path):
+        """Run update in a background thread, unless one is running already
+        """
+        if self.busy():
+            return
+        self.updater = threading.Thread(target=self.update, args=(path,))
+        self.updater.daemon = True
+        self.updater.start()
+
+    def busy(self):
+        return self.updater is not None and self.updater.is_alive()
+
+    def update(self, path):
+        """Index the complete lines added to the gamelog since the last update,
+        starting over when it is another, replaced or truncated file. Returns
+        at once while another thread is updating.
+        """
+        if not self.updating.acquire(False):
+            return
+        try:
+            try:
+                fi = io.open(path, 'rb')
+            except (IOError, OSError):
+                return
+            with fi:
+                size = os.fstat(fi.fileno()).st_size
+                if path != self.path or size < self.indexed or self.head_hash(fi, self.indexed) != self.head:
+                    with self.lock:
+                        self.path, self.head, self.indexed, self.lines, self.sessions = (path, None, 0, 0, [])
+                start = self.indexed
+                now = time.time()
+                fi.seek(self.indexed)
+                while self.indexed < size:
+                    data = b''
+                    stop = 0
+                    while not stop:
+                        # a line can be longer than a chunk: read on to its end
+                        chunk = fi.read(READ_CHUNK)
+                        if not chunk:
+                            break
+                        data += chunk
+                        stop = chunk.rfind(b'\n') + 1
+                        if stop:
+                            stop += len(data) - len(chunk)
+                    if not stop:
+                        break  # the rest is a line still being written
+                    data = b'\n' + data[:stop]  # indexed is at a line start
+                    sessions = []
+                    found = data.find(b'\n' + SESSION_MARKER)
+                    while 0 <= found < stop:
+                        sessions.append([self.indexed + found, self.lines + data.count(b'\n', 1, found + 1), now, now])
+                        found = data.find(b'\n' + SESSION_MARKER, found + 1)
+                    with self.lock:
+                        self.sessions.extend(sessions)
+                        self.lines += data.count(b'\n') - 1
+                        self.indexed += stop
+                    fi.seek(self.indexed)
+                if self.indexed != start:
+                    head = self.head_hash(fi, self.indexed)
+                    with self.lock:
+                        if self.sessions:
+                            self.sessions[-1][3] = now
+                        self.head = head
+                        self.save()
+        finally:
+            self.updating.release()
+
+    def listing(self):
+        """(line number, size in bytes, first seen, last seen) of the sessions
+        indexed so far
+        """
+        with self.lock:
+            listing = []
+            for number in range(0, len(self.sessions)):
+                start, end = self.session_range(number)
+                listing.append((self.sessions[number][1], end - start, self.sessions[number][2], self.sessions[number][3]))
+            return listing
+
+    def session_range(self, number, end=None):
+        """(start, end) byte offsets of a session. The last one is still open and
+        ends at end, by default where the index stops.
+        """
+        with self.lock:
+            start = self.sessions[number][0]
+            if number + 1 < len(self.sessions):
+                return start, self.sessions[number + 1][0]
+            return start, max(end if end is not None else self.indexed, start)
 
 class gamelog(object):
     def __init__(self):
         self.file = None
+        self.offset = 0  # where the next read starts, always just after a newline
+        self.decoder = None
+        self.pending = ''  # decoded text after the last newline read
+        self.identity = None  # (device, inode) of the open file
+        self.watcher = None
+        self.signature = None
+        self.store = announcement_store()
+        self.sessions = session_index()
 
-    def connect(self):
+    def connect(self, resume=False):
+        """Open the gamelog and read new lines from its end, or with resume from
+        where the last run stopped reading when the checkpoint matches the file
+        """
+        self.disconnect()
         if os.path.isfile(Config.settings.get_gamelog_path()):
-            self.file = io.open(Config.settings.get_gamelog_path(), 'r', encoding='cp437')
-            self.file.seek(0, 2)  # Move to the end of the file
+            self.open(at_end=True)
+            self.sessions.start_update(Config.settings.get_gamelog_path())
+            if resume:
+                offset = self.load_checkpoint()
+                if offset is not None:
+                    self.seek(offset)
+            self.changed()
             return True
         else:
             self.file = None
             return False
 
+    def open(self, at_end):
+        """Open the gamelog, reading from the start of its last line or from the
+        beginning of the file
+        """
+        self.file = io.open(Config.settings.get_gamelog_path(), 'rb')
+        st = os.fstat(self.file.fileno())
+        self.identity = (st.st_dev, st.st_ino)
+        self.seek(self.line_start(st.st_size) if at_end else 0)
+        self.watcher = watch_file(Config.settings.get_gamelog_path())
+
+    def disconnect(self):
+        if self.watcher is not None:
+            self.watcher.close()
+            self.watcher = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.identity = None
+
+    def fingerprint(self, offset):
+        """Hash of the first bytes of the file and of the bytes just before offset,
+        enough to tell whether the file was replaced since offset was saved
+        """
+        digest = hashlib.sha1()
+        self.file.seek(0)
+        digest.update(self.file.read(min(offset, FINGERPRINT_BYTES)))
+        start = max(offset - FINGERPRINT_BYTES, 0)
+        self.file.seek(start)
+        digest.update(self.file.read(offset - start))
+        return digest.hexdigest()
+
+    def save_checkpoint(self):
+        """Remember the offset of the first line not read yet, see connect
+        """
+        if self.file is None:
+            return
+        offset = self.read_offset()
+        data = {"path": Config.settings.get_gamelog_path(), "offset": offset, "fingerprint": self.fingerprint(offset)}
+        try:
+            with open(Config.settings.gamelog_checkpoint_path, 'wb') as fo:
+                pickle.dump(data, fo, protocol=0)
+        except (IOError, OSError) as ex:
+            print("Warning: could not save the gamelog checkpoint: %s" % ex)
+
+    def read_offset(self):
+        """Offset of the first line not read yet
+        """
+        return self.offset - len(self.pending.encode('cp437', 'replace'))
+
+    def load_checkpoint(self):
+        """The offset saved by the last run, None when there is none or it was
+        saved for another file
+        """
+        try:
+            with open(Config.settings.gamelog_checkpoint_path, 'rb') as fi:
+                data = pickle.load(fi)
+            offset = data["offset"]
+            if data["path"] != Config.settings.get_gamelog_path() or offset > os.fstat(self.file.fileno()).st_size:
+                return None
+            if self.fingerprint(offset) != data["fingerprint"]:
+                return None
+        except Exception:
+            return None
+        return offset
+
+    def check_file(self):
+        """Follow the gamelog being truncated, replaced or deleted (DFHack
+        restarts, annc.log cleared, a new world). A replaced or deleted file is
+        read to its end and closed; a truncated one is read again from the
+        start; a new file at the path is read from its beginning.
+        Returns the lines that were still unread in a closed file.
+        """
+        try:
+            st = os.stat(Config.settings.get_gamelog_path())
+        except OSError:
+            st = None
+        lines = []
+        if self.file is not None:
+            if st is None or (st.st_dev, st.st_ino) != self.identity:
+                lines = self.read_new_lines()
+                self.disconnect()
+            elif st.st_size < self.offset:
+                self.seek(0)
+        if self.file is None and st is not None:
+            try:
+                self.open(at_end=False)
+            except (IOError, OSError) as ex:
+                print("Warning: could not reopen the gamelog: %s" % ex)
+                self.file = None
+        return lines
+
+    def tail(self):
+        """The complete lines written since the last call, following the file
+        through truncation and replacement
+        """
+        lines = self.check_file()
+        lines.extend(self.read_new_lines())
+        return lines
+
+    def seek(self, offset):
+        self.offset = offset
+        self.decoder = codecs.getincrementaldecoder('cp437')()
+        self.pending = ''
+
+    def line_start(self, offset):
+        """The start of the line containing offset, so a line DF is still writing
+        is read whole later
+        """
+        start = offset
+        while start > 0:
+            block = max(start - READ_CHUNK, 0)
+            self.file.seek(block)
+            newline = self.file.read(start - block).rfind(b'\n')
+            if newline >= 0:
+                return block + newline + 1
+            start = block
+        return 0
+
+    def read_new_lines(self):
+        """The complete lines written since the last read. Raw bytes are read in
+        large chunks from the tracked offset and decoded incrementally; a
+        trailing partial line is kept until the rest of it is written.
+        """
+        if not self.file:
+            return []
+        self.file.seek(self.offset)
+        text = [self.pending]
+        while True:
+            data = self.file.read(READ_CHUNK)
+            if not data:
+                break
+            self.offset += len(data)
+            text.append(self.decoder.decode(data))
+        text = ''.join(text)
+        end = text.rfind('\n') + 1
+        self.pending = text[end:]
+        return self.get_lines(text[:end].split('\n'))
+
+    def changed(self):
+        """True when the gamelog's size, modification time, inode or existence
+        differ from the last call; a stat is much cheaper than attempting a read
+        """
+        try:
+            st = os.stat(Config.settings.get_gamelog_path())
+            signature = (st.st_size, st.st_mtime, st.st_ino)
+        except OSError:
+            signature = None
+        if signature != self.signature:
+            self.signature = signature
+            return True
+        return False
+
     def get_new_announcements(self, list_=None):
+        """Read, classify and store the new lines; returns their store indices
+        """
         if list_ is None:
-            list_ = self.file
-        new = []
+            lines, counts = self.coalesce(self.tail())
+            group_ids, category_ids = Filters.expressions.classify_many(lines)
+            return self.store_announcements(lines, category_ids, counts)
         if self.file:
-            for newline in list_:
-                s = newline.strip()
-                if len(s) != 0:
-                    new.append(announcement(s))
-        return new
+            lines, counts = self.coalesce(self.get_lines(list_))
+            group_ids, category_ids = Filters.expressions.classify_many(lines)
+            return self.store_announcements(lines, category_ids, counts)
+        return self.store_announcements([], [])
 
-    def get_old_announcements(self):
+    def get_lines(self, list_):
         lines = []
-        if self.file:
-            self.file.seek(0, 0)
-            exp = re.compile('\*\* Loading Fortress \*\*')
-            for line in self.file:
-                if exp.match(line):
-                    lines = []
-                lines.append(line)
-        return self.get_new_announcements(list_=lines)
+        for newline in list_:
+            s = newline.strip()
+            if len(s) != 0:
+                lines.append(s)
+        return lines
+
+    def coalesce(self, lines):
+        """Collapse runs of identical lines; returns the lines and their repeat
+        counts
+        """
+        unique = []
+        counts = array('L')
+        for line in lines:
+            if unique and line == unique[-1]:
+                counts[-1] += 1
+            else:
+                unique.append(line)
+                counts.append(1)
+        return unique, counts
+
+    def store_announcements(self, lines, category_ids, counts=None):
+        return self.store.extend(lines, category_ids, counts)
+
+    def session_start(self, end):
+        """Offset of the last line before end starting with SESSION_MARKER, 0 when
+        there is none. The file is searched backward from end, through mmap where
+        possible, so only the current session is ever read.
+        """
+        marker = b'\n' + SESSION_MARKER  # a marker at offset 0 needs no search
+        try:
+            data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, EnvironmentError):
+            data = None
+        if data is not None:
+            try:
+                return data.rfind(marker, 0, end) + 1
+            finally:
+                data.close()
+        stop = end
+        while stop > 0:
+            start = max(stop - READ_CHUNK, 0)
+            self.file.seek(start)
+            # Overlap the next block so a marker split across blocks is found
+            found = self.file.read(min(stop + len(marker) - 1, end) - start).rfind(marker)
+            if found >= 0:
+                return start + found + 1
+            stop = start
+        return 0
+
+    def get_old_lines(self):
+        """Lines written since the last time a fortress was loaded, up to where
+        the tail starts reading
+        """
+        if not self.file:
+            return []
+        start = self.session_start(self.offset)
+        self.file.seek(start)
+        return self.get_lines(self.file.read(self.offset - start).decode('cp437').split('\n'))
+
+    def get_session_lines(self, number):
+        """The lines of a session listed in self.sessions. The current session
+        ends where the tail has read to, so no line is left out or repeated
+        (pause the reader thread around the call).
+        """
+        with self.sessions.lock:
+            path = self.sessions.path
+            end = self.read_offset() if self.file is not None and path == Config.settings.get_gamelog_path() else None
+            start, end = self.sessions.session_range(number, end)
+        with io.open(path, 'rb') as fi:
+            fi.seek(start)
+            return self.get_lines(fi.read(end - start).decode('cp437').split('\n'))
+
+    def get_old_announcements(self):
+        lines, counts = self.coalesce(self.get_old_lines())
+        group_ids, category_ids = Filters.expressions.classify_many(lines)
+        return self.store_announcements(lines, category_ids, counts)
 
     def new(self):
         return self.get_new_announcements()
 
     def get_all_announcements(self):
         if self.file:
-            self.file.seek(0, 0)
+            self.seek(0)
         return self.get_new_announcements()
 
+class reader_thread(threading.Thread):
+    """Tails the gamelog off the Tk thread: waits for writes, reads new lines,
+    classifies and word-segments them, and puts ready batches of
+    (lines, category ids, repeat counts, segments) on self.queue. notify is
+    called after every put so the UI can wake up and drain the queue.
+    """
+    def __init__(self, gamelog_, notify=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.gamelog = gamelog_
+        self.notify = notify
+        self.queue = queue.Queue()
+        self.stopping = threading.Event()
+        self.reading = threading.Lock()
+        self.interval = POLL_MIN
+        self.saved = timer()
+        self.wake_r, self.wake_w = (None, None)
+        if not util.platform.win:
+            # select() takes pipes everywhere but Windows. Made even without a
+            # watcher: the gamelog may only be created (and watched) later.
+            self.wake_r, self.wake_w = os.pipe()
+
+    def run(self):
+        try:
+            while not self.stopping.is_set():
+                with self.reading:
+                    if self.stopping.is_set():
+                        break
+                    if self.gamelog.changed():
+                        self.read()
+                        self.interval = POLL_MIN
+                        if timer() - self.saved > CHECKPOINT_INTERVAL:
+                            self.gamelog.save_checkpoint()
+                            self.gamelog.sessions.update(Config.settings.get_gamelog_path())
+                            self.saved = timer()
+                    else:
+                        self.interval = min(self.interval * 2, POLL_MAX)
+                self.wait()
+        finally:
+            if self.wake_r is not None:
+                os.close(self.wake_r)  # the write end is closed by stop()
+
+    def wait(self):
+        """Sleep until the gamelog is written (inotify) or the poll interval
+        passes, returning early when stopped. The watcher is looked up on every
+        pass, as check_file replaces it when the file is (re)created.
+        """
+        if self.wake_r is None or self.gamelog.watcher is None:
+            self.stopping.wait(self.interval)
+            return
+        try:
+            ready = select.select([self.gamelog.watcher.fileno(), self.wake_r], [], [], POLL_WATCHED)[0]
+        except (select.error, ValueError):
+            return
+        if self.gamelog.watcher.fileno() in ready:
+            self.gamelog.watcher.drain()
 
+    def read(self):
+        lines, counts = self.gamelog.coalesce(self.gamelog.tail())
+        registry = Filters.expressions.registry
+        for start in range(0, len(lines), READ_BATCH):
+            batch = lines[start:start + READ_BATCH]
+            group_ids, category_ids = Filters.expressions.classify_many(batch)
+            segments = []
+            for position in range(0, len(batch)):
+                group = registry.group_names[category_ids[position]] if category_ids[position] >= 0 else None
+                segments.append(WordColor.wd.segment(batch[position], group))
+            self.queue.put((batch, category_ids, counts[start:start + READ_BATCH], segments))
+            if self.notify is not None:
+                self.notify()
 
+    def stop(self):
+        """Stop tailing; returns once no read is in progress, so the gamelog can
+        be reconnected
+        """
+        self.stopping.set()
+        if self.wake_w is not None:
+            try:
+                os.write(self.wake_w, b'x')
+            except OSError:
+                pass
+            os.close(self.wake_w)
+            self.wake_w = None
+        with self.reading:
+            pass
@@ -24,10 +24,12 @@ else:
     raise UserWarning("unknown python version?!")
 
 import re
+import time
 from functools import partial
 
 import Filters
 import Config
+import WordColor
 import util
 
 LEFT = Tkinter.LEFT
@@ -121,6 +123,11 @@ class ExpressionBar(Tkinter.Frame):
                 self.category.re_expressions[self.index] = compiled
             except Exception:
                 pass
+            # the combined classifier still holds the old pattern
+            try:
+                Filters.expressions.invalidate()
+            except Exception:
+                pass
             RE_MODIFIED = True
             return True
         except Exception:
@@ -268,6 +275,10 @@ class GroupBar(Tkinter.Frame):
 
         self.color_button.grid(row=0, column=1)
 
+        # How many words wordcolor.txt highlights in this group (General included)
+        word_count = len(WordColor.wd.get_color_map(getattr(group, "group", None)))
+        Tkinter.Label(header, text="%d words" % word_count, fg="gray").grid(row=0, column=2)
+
         header.grid(row=0, column=1, sticky="w")
 
         # Categories frame
@@ -696,4 +707,159 @@ class MainDialog(Tkinter.Toplevel):
             self.grab_release()
         except Exception:
             pass
-        self.destroy()
\ No newline at end of file
+        self.destroy()
+
+
+# ------------------------------ statistics ---------------------------------- #
+
+class StatsDialog(Tkinter.Toplevel):
+    """
+    Sortable per-rule match statistics (hits and cumulative match time).
+    Statistics are only recorded while "Record" is checked, which makes
+    classification rule-by-rule and therefore slower.
+    """
+    columns = [("Hits", 4), ("Time (ms)", 5), ("Group", 0), ("Category", 1), ("Pattern", 3)]
+
+    def __init__(self, parent, expressions=None):
+        Tkinter.Toplevel.__init__(self, parent)
+        self.parent = parent
+        self.expressions = expressions if expressions is not None else Filters.expressions
+        self.sort_column = 4
+        self.never_matched = False
+
+        try:
+            self.iconbitmap(Config.settings.icon_path)
+        except Exception:
+            pass
+        self.title("Filter Statistics")
+
+        toolbar = Tkinter.Frame(self)
+        self.record = Tkinter.BooleanVar()
+        self.record.set(bool(self.expressions.profiling))
+        Tkinter.Checkbutton(toolbar, text="Record", variable=self.record,
+                            command=self.set_profiling).pack(side=LEFT)
+        Tkinter.Button(toolbar, text="Refresh", command=self.refresh).pack(side=LEFT)
+        Tkinter.Button(toolbar, text="Never Matched", command=self.show_never_matched).pack(side=LEFT)
+        Tkinter.Button(toolbar, text="Reset", command=self.reset).pack(side=LEFT)
+        Tkinter.Button(toolbar, text="Print", command=self.expressions.print_filter_stats).pack(side=LEFT)
+        Tkinter.Button(toolbar, text="Save Report", command=self.save).pack(side=LEFT)
+        toolbar.grid(row=0, column=0, columnspan=2, sticky="w")
+
+        header = Tkinter.Frame(self)
+        for label, column in self.columns:
+            Tkinter.Button(header, text=label, relief="flat",
+                           command=partial(self.sort, column)).pack(side=LEFT)
+        header.grid(row=1, column=0, columnspan=2, sticky="w")
+
+        self.listbox = Tkinter.Listbox(self, width=120, height=30, font=("Courier", 9))
+        vscroll = Tkinter.Scrollbar(self, orient="vertical", command=self.listbox.yview)
+        self.listbox.configure(yscrollcommand=vscroll.set)
+        self.listbox.grid(row=2, column=0, sticky="nsew")
+        vscroll.grid(row=2, column=1, sticky="ns")
+        self.grid_columnconfigure(0, weight=1)
+        self.grid_rowconfigure(2, weight=1)
+
+        self.refresh()
+
+    def set_profiling(self):
+        self.expressions.set_profiling(self.record.get())
+
+    def sort(self, column):
+        self.sort_column = column
+        self.never_matched = False
+        self.refresh()
+
+    def show_never_matched(self):
+        self.never_matched = True
+        self.refresh()
+
+    def reset(self):
+        self.expressions.reset_stats()
+        self.refresh()
+
+    def save(self):
+        try:
+            self.expressions.save_filter_stats()
+            print("Filter statistics saved to %s" % Config.settings.filter_stats_path)
+        except Exception as ex:
+            print("Warning: save_filter_stats failed: %s" % ex)
+
+    def refresh(self):
+        stats = self.expressions.rule_stats()
+        if self.never_matched:
+            stats = [rule for rule in stats if rule[4] == 0]
+        elif self.sort_column in (4, 5):
+            stats.sort(key=lambda rule: rule[self.sort_column], reverse=True)
+        else:
+            stats.sort(key=lambda rule: rule[self.sort_column])
+        self.listbox.delete(0, "end")
+        for group, category, index, pattern, hits, seconds in stats:
+            self.listbox.insert("end", "%8d %10.3f  %-14s %-20s %s" % (hits, seconds * 1000, group, category, pattern))
+
+
+class SessionDialog(Tkinter.Toplevel):
+    """
+    Lists the fortress sessions found in the gamelog ("** Loading Fortress **"
+    lines, see GamelogReader.session_index). Loading one replaces what the
+    windows show with that session's announcements. While the gamelog is still
+    being indexed, the list is refreshed as sessions are found.
+    """
+
+    def __init__(self, parent, sessions):
+        Tkinter.Toplevel.__init__(self, parent)
+        self.parent = parent
+        self.sessions = sessions
+
+        try:
+            self.iconbitmap(Config.settings.icon_path)
+        except Exception:
+            pass
+        self.title("Load Session")
+
+        toolbar = Tkinter.Frame(self)
+        Tkinter.Button(toolbar, text="Load", command=self.load).pack(side=LEFT)
+        Tkinter.Button(toolbar, text="Close", command=self.destroy).pack(side=LEFT)
+        toolbar.grid(row=0, column=0, columnspan=2, sticky="w")
+
+        self.listbox = Tkinter.Listbox(self, width=80, height=20, font=("Courier", 9))
+        vscroll = Tkinter.Scrollbar(self, orient="vertical", command=self.listbox.yview)
+        self.listbox.configure(yscrollcommand=vscroll.set)
+        self.listbox.grid(row=1, column=0, sticky="nsew")
+        vscroll.grid(row=1, column=1, sticky="ns")
+        self.listbox.bind("<Double-Button-1>", lambda event: self.load())
+        self.grid_columnconfigure(0, weight=1)
+        self.grid_rowconfigure(1, weight=1)
+
+        self.listbox.insert("end", "%4s %10s %10s  %-16s  %-16s" % ("#", "Line", "Size (KB)", "First seen", "Last seen"))
+        self.refresh()
+
+    def refresh(self):
+        """List the sessions indexed so far; again in a moment while indexing
+        """
+        if not self.winfo_exists():
+            return
+        busy = self.sessions.busy()
+        selection = self.listbox.curselection()
+        at_end = self.listbox.yview()[1] == 1.0
+        self.listbox.delete(1, "end")
+        listing = self.sessions.listing()
+        for number in range(0, len(listing)):
+            line, size, first_seen, last_seen = listing[number]
+            self.listbox.insert("end", "%4d %10d %10d  %-16s  %-16s" % (
+                number + 1, line + 1, size // 1024,
+                time.strftime("%Y-%m-%d %H:%M", time.localtime(first_seen)),
+                time.strftime("%Y-%m-%d %H:%M", time.localtime(last_seen))))
+        for index in selection:
+            self.listbox.selection_set(index)
+        if at_end:
+            self.listbox.see("end")
+        self.title("Load Session (indexing...)" if busy else "Load Session")
+        if busy:
+            self.after(500, self.refresh)
+
+    def load(self):
+        selection = self.listbox.curselection()
+        if not selection or int(selection[0]) == 0:
+            return
+        self.parent.load_session(int(selection[0]) - 1)
+        self.destroy()
@@ -14,7 +14,8 @@ elif  sys.version_info.major == 3:
 else:
     raise UserWarning("unknown python version?!")
 
-import re
+import heapq
+from bisect import bisect_left
 import tkFontChooser
 import Config
 import Editor
@@ -23,14 +24,35 @@ import WordColor
 import GamelogReader
 import util
 import os
+import multiprocessing
 import TagConfig
 from collections import OrderedDict
 
 # import psutil,time
 
+FRAME_BUDGET_MS = 30  # time spent showing queued announcements before Tk gets to redraw
+
 def dict_to_font(dict_):
     return tkFont.Font(family=dict_["family"], size=dict_["size"], weight=dict_["weight"], slant=dict_["slant"], overstrike=dict_["overstrike"], underline=dict_["underline"])
 
+def render(text, category_id, count=1, segments=None):
+    """An announcement as the (chars, tags, chars, tags, ...) runs passed to
+    Text.insert, with its repeat count when it was coalesced. segments is the
+    word coloring from WordColor.wd.segment, computed here when not given. The
+    runs are rendered once and shared by every window showing the line.
+    """
+    registry = Filters.expressions.registry
+    tag_name = registry.tag_names[category_id]
+    if segments is None:
+        segments = WordColor.wd.segment(text, registry.group_names[category_id])
+    runs = []
+    for piece, colorname in segments:
+        runs.extend((piece, (tag_name, colorname) if colorname else tag_name))
+    if count > 1:
+        runs.extend((" x%d" % count, tag_name))
+    runs.extend(("\n", tag_name))
+    return tuple(runs)
+
 class announcement_window(Tkinter.Frame):
     def __init__(self, parent, id_):
         Tkinter.Frame.__init__(self, parent)
@@ -38,6 +60,12 @@ class announcement_window(Tkinter.Frame):
         self.id = id_
         self.show_tags = False
         self.index_dict = {}
+        self.start = 0  # first store index shown since the window was cleared
+        self.hidden = {}  # category id -> [[first, end]] store indices read while it was hidden, end None while it still is
+        self.shown = bytearray()
+        self.last_index = -1  # store index of the bottom line
+        self.pending = []  # runs of the lines to insert at the next flush, None once trimmed
+        self.pending_by_category = {}  # category id -> positions in self.pending, oldest first
         Filters.expressions.add_window(self.id)
         self.customFont = dict_to_font(self.parent.gui_data['font_w%s' % self.id])
         self.config_gui = None
@@ -113,6 +141,7 @@ class announcement_window(Tkinter.Frame):
         self.config(state="normal")
         self.gen_tags()
         self.config(state="disabled")
+        self.rebuild()
 
     def edit_font(self):
         tup = tkFontChooser.askChooseFont(self.parent, defaultfont=self.customFont)
@@ -125,10 +154,15 @@ class announcement_window(Tkinter.Frame):
         self.config_gui.destroy()
         self.config_gui = None
         Filters.expressions.save_filter_data()
-        Filters.expressions.reload()
         self.parent.gen_tags()
 
     def clear_window(self):
+        self.start = len(self.parent.gamelog.store)
+        self.parent.gamelog.store.seal()
+        self.last_index = -1
+        self.pending = []
+        self.pending_by_category = {}
+        self.parent.update_eviction()
         self.config(state="normal")
         self.delete('1.0', "end")
         self.gen_tags(clear_index_dict=True)
@@ -139,89 +173,156 @@ class announcement_window(Tkinter.Frame):
         """        
         self.vsb_pos = (self.vsb.get()[1])
         colordict=Config.settings.word_color_dict
-        for group_ in Filters.expressions.groups.items():
+        registry = Filters.expressions.registry
+        for category_id in Filters.expressions.category_ids:
             # Group Coloring
-            group = group_[1]
-            for category_ in group.categories.items():
-                category = category_[1]
-                tag_name = "%s.%s" % (group.group, category.category)
-                # set_elide =
-                self.tag_config('%s.elide' % tag_name, foreground="#FFF", elide=not (self.show_tags and category.get_show(self.id)))
-                self.tag_config(tag_name, foreground=group.color, elide=not category.get_show(self.id))
-                if clear_index_dict:
-                    self.index_dict[tag_name] = 0
-                elif not (tag_name in self.index_dict):
-                    self.index_dict[tag_name] = 0
+            self.tag_config(registry.elide_tag_names[category_id], foreground="#FFF")
+            self.tag_config(registry.tag_names[category_id], foreground=registry.colors[category_id])
+            if clear_index_dict or not (category_id in self.index_dict):
+                self.index_dict[category_id] = 0
         for color in colordict:
             # Word Coloring
             self.tag_config(color, foreground=colordict[color][0], background=colordict[color][1])
         if self.vsb_pos == 1.0:
             self.yview("end")
+        self.update_hidden()
+
+    def update_hidden(self):
+        """Without save_hidden_announcements, a category that becomes visible
+        again shows what it showed before it was hidden, but not the lines read
+        while it was hidden
+        """
+        registry = Filters.expressions.registry
+        shows = registry.shows[self.id] if self.id < len(registry.shows) else bytearray()
+        now = len(self.parent.gamelog.store)
+        if Config.settings.save_hidden_announcements:
+            self.hidden.clear()
+        else:
+            for category_id in range(0, len(shows)):
+                known = category_id < len(self.shown)
+                if not shows[category_id] and (not known or self.shown[category_id]):
+                    self.hidden.setdefault(category_id, []).append([now, None])
+                elif shows[category_id] and known and not self.shown[category_id]:
+                    intervals = self.hidden.get(category_id)
+                    if intervals and intervals[-1][1] is None:
+                        if intervals[-1][0] == now:
+                            intervals.pop()  # nothing was read while hidden
+                        else:
+                            intervals[-1][1] = now
+        self.shown = bytearray(shows)
+
+    def visible_runs(self, category_id, positions):
+        """The slices of a category's history the window shows: from start on,
+        leaving out the lines read while the category was hidden, limited to the
+        newest trim_announcements lines
+        """
+        slices = []
+        first = bisect_left(positions, self.start)
+        for hidden_from, shown_again in self.hidden.get(category_id, ()):
+            end = bisect_left(positions, hidden_from)
+            if end > first:
+                slices.append([first, end])
+            first = max(first, bisect_left(positions, shown_again) if shown_again is not None else len(positions))
+        if first < len(positions):
+            slices.append([first, len(positions)])
+        limit = Config.settings.trim_announcements[self.id]
+        if limit:
+            count = 0
+            for position in range(len(slices) - 1, -1, -1):
+                if count + slices[position][1] - slices[position][0] >= limit:
+                    slices[position][0] = slices[position][1] - (limit - count)
+                    slices = slices[position:]
+                    break
+                count += slices[position][1] - slices[position][0]
+        return [positions[first:end] for first, end in slices]
+
+    def rebuild(self, rendered=None):
+        """Refill the window from the announcement history in one insert: the
+        lines of every category shown here, oldest first, limited by
+        trim_announcements. rendered maps store indices to their runs and is
+        shared by windows rebuilt together.
+        """
+        if rendered is None:
+            rendered = {}
+        store = self.parent.gamelog.store
+        registry = Filters.expressions.registry
+        runs = []
+        self.index_dict = {}
+        for category_id, positions in store.history.items():
+            if not registry.get_show(category_id, self.id):
+                continue
+            visible = self.visible_runs(category_id, positions)
+            if visible:
+                runs.extend(visible)
+                self.index_dict[category_id] = sum([len(run) for run in visible])
+        args = []
+        self.last_index = -1
+        for index in heapq.merge(*runs):
+            if index not in rendered:
+                rendered[index] = render(store.get_text(index), store.get_category_id(index), store.get_count(index))
+            args.extend(self.with_prefix(store.get_category_id(index), rendered[index]))
+            self.last_index = index
+        self.vsb_pos = (self.vsb.get()[1])
+        self.config(state="normal")
+        self.delete('1.0', "end")
+        if args:
+            self.insert("end", *args)
+        self.config(state="disabled")
+        if self.vsb_pos == 1.0:
+            self.yview("end")
 
-
-    def insert_ann(self, ann):
-        def insert():
-            anngroup = ann.get_group()
-            anncat   = ann.get_category()
-            tag_name = "%s.%s" % (anngroup, anncat)
-
-            # prefix ([group][category]) as in the original
-            self.insert("end", "[%s][%s] " % (anngroup, anncat), '%s.elide' % tag_name)
-
-            text  = ann.get_text()
-            words = WordColor.wd.get_all_group_words(anngroup) or []
-
-            if words:
-                # Build regex that captures the WORD and the following separator (space/punct/EOL).
-                # We tag only the word, then re-emit the exact separator so spacing/punctuation remains intact.
-                pattern = r'(\b(?:' + '|'.join(map(re.escape, words)) + r')\b)(?P<sep>\s|[.,;:!?)\]]|$)'
-                regex = re.compile(pattern)
-
-                pos = 0
-                for m in regex.finditer(text):
-                    # 1) Text before match (unchanged)
-                    if m.start() > pos:
-                        self.insert("end", text[pos:m.start()], tag_name)
-
-                    # 2) Matched word
-                    word = m.group(1)
-                    self.insert("end", word, tag_name)
-
-                    # Tag the word span we just inserted
-                    colorname = WordColor.wd.get_colorname(word, anngroup)
-                    if colorname:
-                        start = "end-" + str(1 + len(word)) + "c"
-                        end   = "end-1c"
-                        self.tag_add(colorname, start, end)
-
-                    # 3) The exact following separator (space/punct/EOL)
-                    sep = m.group('sep')
-                    if sep:
-                        self.insert("end", sep, tag_name)
-
-                    pos = m.end()
-
-                # 4) Remainder after the last match
-                if pos < len(text):
-                    self.insert("end", text[pos:], tag_name)
-            else:
-                # No color words configured for this group — insert as-is
-                self.insert("end", text, tag_name)
-
-            self.trim_announcements(tag_name)
-
-        if ann.get_show(self.id):
-            insert()
-        elif Config.settings.save_hidden_announcements:
-            insert()
-
-
-    def trim_announcements(self, tag_name):
+    def insert_ann(self, index, category_id, runs):
+        """Queue the announcement at store index, rendered by render(), for the
+        next flush; the caller checks that its category is shown here
+        """
+        runs = self.with_prefix(category_id, runs)
+        if index == self.last_index:
+            # The bottom line repeated: redraw it with the new count
+            if self.pending:
+                self.pending[-1] = runs
+                return
+            self.delete("end-2c linestart", "end-1c")
+        self.pending_by_category.setdefault(category_id, []).append(len(self.pending))
+        self.pending.append(runs)
+        if index != self.last_index:
+            self.trim_announcements(category_id)
+            self.last_index = index
+
+    def flush(self):
+        """Insert the queued lines with a single Text.insert
+        """
+        args = []
+        for runs in self.pending:
+            if runs is not None:
+                args.extend(runs)
+        if args:
+            self.insert("end", *args)
+        self.pending = []
+        self.pending_by_category = {}
+
+    def with_prefix(self, category_id, runs):
+        """runs with the [group][category] prefix when tags are shown
+        """
+        if self.show_tags:
+            registry = Filters.expressions.registry
+            return (registry.prefixes[category_id], registry.elide_tag_names[category_id]) + runs
+        return runs
+
+    def trim_announcements(self, category_id):
+        """Drop the oldest line of the category once it has more than
+        trim_announcements lines; one still waiting for the flush is simply
+        never inserted
+        """
         if Config.settings.trim_announcements[self.id]:
-            self.index_dict[tag_name] += 1
-            if self.index_dict[tag_name] > Config.settings.trim_announcements[self.id]:
-                index = int(float(self.text.index('%s.first' % tag_name)))
-                self.delete("%d.0" % index, "%d.0" % (index + 1))
+            self.index_dict[category_id] = self.index_dict.get(category_id, 0) + 1
+            if self.index_dict[category_id] > Config.settings.trim_announcements[self.id]:
+                pending = self.pending_by_category[category_id]
+                if self.index_dict[category_id] > len(pending):
+                    index = int(float(self.text.index('%s.first' % Filters.expressions.registry.tag_names[category_id])))
+                    self.delete("%d.0" % index, "%d.0" % (index + 1))
+                else:
+                    self.pending[pending.pop(0)] = None
+                self.index_dict[category_id] -= 1
 
 class main_gui(Tkinter.Tk):
     def __init__(self):
@@ -234,10 +335,19 @@ class main_gui(Tkinter.Tk):
         self.customFont = tkFont.Font(family='Lao UI', size=10)
         self.gui_data = Config.settings.load_gui_data()
         self.gamelog = GamelogReader.gamelog()
-        self.connect()
+        self.reader = None
+        self.wake_pending = False
+        self.poll_interval = GamelogReader.POLL_MIN  # seconds, see poll_queue
+        self.wake_r, self.wake_w = (None, None)
+        if hasattr(self.tk, 'createfilehandler'):
+            self.wake_r, self.wake_w = os.pipe()
+            self.tk.createfilehandler(self.wake_r, Tkinter.READABLE, self.reader_woke)
+        self.connect(resume=True)
         self.announcement_windows = OrderedDict([])
         self.cpu_max = {}
         self.py = None
+        self.backlog = None
+        self.backlog_counts = None
         if self.gui_data is None:
             self.gui_data = {"sash_place":int(700 / 3.236)}
 
@@ -250,7 +360,10 @@ class main_gui(Tkinter.Tk):
         self.init_windows()
         self.gen_tags()
         # self.parallel()
-        self.get_announcements(old=Config.settings.load_previous_announcements)
+        if Config.settings.load_previous_announcements:
+            self.load_backlog()
+        else:
+            self.get_announcements()
         self.pack_announcements()
 
     def init_menu(self):
@@ -259,8 +372,10 @@ class main_gui(Tkinter.Tk):
         options_menu = Tkinter.Menu(self.menu, tearoff=0)
         options_menu.add_command(label="Filter Configuration", command=self.config_gui)
         options_menu.add_command(label="Edit filters.txt", command=self.open_filters)
+        options_menu.add_command(label="Filter Statistics", command=self.stats_gui)
+        options_menu.add_command(label="Load Session", command=self.sessions_gui)
         options_menu.add_command(label="Reload wordcolor.txt", command=WordColor.wd.reload)
-        options_menu.add_command(label="Reload filters.txt", command=Filters.expressions.reload)
+        options_menu.add_command(label="Reload filters.txt", command=self.gen_tags)
         options_menu.add_command(label="Reload Settings", command=self.reload_settings)
 
         self.settings_menu = Tkinter.Menu(self.menu, tearoff=0)
@@ -273,10 +388,16 @@ class main_gui(Tkinter.Tk):
 
         self.config(menu=self.menu)
 
-    def connect(self):
-        if not self.gamelog.connect():
+    def connect(self, resume=False):
+        reading = self.reader is not None
+        if reading:
+            self.reader.stop()
+            self.drain_queue(budget_ms=None)
+        if not self.gamelog.connect(resume):
             # TODO: add dialog when gamelog is not found
             pass
+        if reading:
+            self.start_reader()
 
     def dump_info(self):
         print('CPU-MAX:%f' % max(self.cpu_max["CPU"]))
@@ -315,13 +436,36 @@ class main_gui(Tkinter.Tk):
         #     pass
 
     def gen_tags(self):
-        Filters.expressions.reload()
+        changed = Filters.expressions.reload()
+        self.update_eviction()
+        rendered = {}
         for announcement_win in self.announcement_windows.items():
             announcement_win[1].config(state="normal")
             announcement_win[1].gen_tags()
             announcement_win[1].config(state="disabled")
+            if announcement_win[0] in changed:
+                announcement_win[1].rebuild(rendered)
+
+    def update_eviction(self):
+        """Tell the announcement store which lines no window can show again:
+        those from before every window was last cleared, and, when every window
+        trims its categories, all but the newest lines of each category
+        """
+        store = self.gamelog.store
+        store.limit = Config.settings.announcement_history_size
+        store.floor = min([win.start for win in self.announcement_windows.values()] or [0])
+        trims = Config.settings.trim_announcements[:len(self.announcement_windows)]
+        store.keep = max(trims) if trims and min(trims) > 0 else None
+        store.evict()
 
     def clean_exit(self):
+        if self.backlog is not None:
+            self.backlog.terminate()
+        if self.reader is not None:
+            self.reader.stop()
+        if Filters.expressions.profiling:
+            Filters.expressions.print_filter_stats()
+        self.gamelog.save_checkpoint()
         # self.gui_data["sash_place"] = self.panel.sash_coord(0)[1]
         Config.settings.save_gui_data(self.gui_data)
         self.destroy()
@@ -341,6 +485,32 @@ class main_gui(Tkinter.Tk):
         TagConfig.MainDialog(self)
         self.gen_tags()
 
+    def stats_gui(self):
+        TagConfig.StatsDialog(self)
+
+    def sessions_gui(self):
+        self.gamelog.sessions.start_update(Config.settings.get_gamelog_path())
+        TagConfig.SessionDialog(self, self.gamelog.sessions)
+
+    def load_session(self, number):
+        """Replace what the windows show with a fortress session from the gamelog;
+        new announcements keep being added below it
+        """
+        if self.backlog is not None:
+            return  # still loading
+        if self.reader is not None:
+            # Show what the reader has queued, and keep it from reading on, so the
+            # session ends exactly where the live announcements start
+            self.reader.reading.acquire()
+            self.drain_queue(budget_ms=None)
+        try:
+            for announcement_win in self.announcement_windows.items():
+                announcement_win[1].clear_window()
+            self.load_backlog(self.gamelog.get_session_lines(number))
+        finally:
+            if self.reader is not None:
+                self.reader.reading.release()
+
     def askpath(self):
         path = Config.settings.get_gamelog_path()
         if os.path.isfile(path):
@@ -361,23 +531,118 @@ class main_gui(Tkinter.Tk):
         tog_ = 'Unlock Window' if self.locked else 'Lock Window'
         self.settings_menu.entryconfig(self.settings_menu.index('end'), label=tog_)
 
-    def get_announcements(self, old=False):
-        if old:
-            new_announcements = self.gamelog.get_old_announcements()
+    def load_backlog(self, lines=None):
+        """Classify the previous session's announcements (or the given lines) in
+        worker processes and show them chunk by chunk; live announcements are
+        shown once the backlog is.
+        """
+        if lines is None:
+            lines = self.gamelog.get_old_lines()
+        lines, self.backlog_counts = self.gamelog.coalesce(lines)
+        # The worker processes start here; see Filters.pool_context for why the
+        # reader must not be mid-read (load_session holds reader.reading) nor
+        # the session indexer mid-update
+        with self.gamelog.sessions.lock:
+            self.backlog = Filters.parallel_classifier(Filters.expressions, lines)
+        self.after(0, self.fill_backlog)
+
+    def fill_backlog(self):
+        new_announcements = []
+        for lines, category_ids in self.backlog.ready_chunks():
+            counts = self.backlog_counts[:len(lines)]
+            del self.backlog_counts[:len(lines)]
+            # The range starts one early when the chunk's first line was added to
+            # the last stored entry's count, so that line is redrawn too
+            new_announcements.extend(self.gamelog.store_announcements(lines, category_ids, counts))
+        self.insert_announcements(new_announcements)
+        if self.backlog.done():
+            self.backlog = None
+            self.get_announcements()
+            self.drain_queue()
+        else:
+            self.after(50, self.fill_backlog)
+
+    def get_announcements(self):
+        if self.reader is None:
+            self.start_reader()
+            if self.wake_r is None:
+                self.poll_queue()
+
+    def start_reader(self):
+        """Tail the gamelog in a background thread (see GamelogReader.reader_thread)
+        """
+        self.reader = GamelogReader.reader_thread(self.gamelog, self.wake if self.wake_w is not None else None)
+        self.reader.start()
+
+    def wake(self):
+        """Called from the reader thread after it queued a batch
+        """
+        if not self.wake_pending:
+            self.wake_pending = True
+            os.write(self.wake_w, b'x')
+
+    def reader_woke(self, fd, mask):
+        os.read(self.wake_r, 512)
+        self.wake_pending = False
+        self.drain_queue()
+
+    def poll_queue(self):
+        """Where Tk cannot wait on the wake pipe: check the queue often while
+        batches arrive, backing off like the reader while nothing comes
+        """
+        if self.drain_queue():
+            self.poll_interval = GamelogReader.POLL_MIN
         else:
-            new_announcements = self.gamelog.new()
+            self.poll_interval = min(self.poll_interval * 2, GamelogReader.POLL_MAX)
+        self.after(int(self.poll_interval * 1000), self.poll_queue)
+
+    def drain_queue(self, budget_ms=FRAME_BUDGET_MS):
+        """Show the batches queued by the reader for at most budget_ms; the rest
+        follows once Tk has processed its events and redrawn. Returns True when
+        something was shown.
+        """
+        if self.reader is None or self.backlog is not None:
+            return False
+        deadline = Filters.timer() + budget_ms / 1000.0 if budget_ms is not None else None
+        shown = False
+        while True:
+            try:
+                lines, category_ids, counts, segments = self.reader.queue.get_nowait()
+            except GamelogReader.queue.Empty:
+                return shown
+            self.insert_announcements(self.gamelog.store_announcements(lines, category_ids, counts), segments)
+            shown = True
+            if deadline is not None and Filters.timer() > deadline:
+                self.after(1, self.drain_queue)
+                return shown
+
+    def insert_announcements(self, new_announcements, segments=None):
+        """Show the announcements at the given indices of the gamelog store, with
+        their word segments when the reader already computed them. Each line is
+        rendered once for all windows, and each window gets a single insert.
+        """
         if new_announcements:
+            store = self.gamelog.store
+            registry = Filters.expressions.registry
             for announcement_win in self.announcement_windows.items():
                 announcement_win[1].vsb_pos = (announcement_win[1].vsb.get()[1])  # Jumps to end of list if the users scrollbar is @ end of list, otherwise holds current position
                 announcement_win[1].text.config(state="normal")
-            for ann in new_announcements:
-                for announcement_win in self.announcement_windows.items():
-                    announcement_win[1].insert_ann(ann)
+            for position in range(0, len(new_announcements)):
+                index = new_announcements[position]
+                if index < store.base:
+                    continue  # evicted by a later batch
+                category_id = store.get_category_id(index)
+                windows = [win for win in self.announcement_windows.values() if registry.get_show(category_id, win.id)]
+                if windows:
+                    runs = render(store.get_text(index), category_id, store.get_count(index),
+                                  segments[position] if segments is not None else None)
+                    for win in windows:
+                        win.insert_ann(index, category_id, runs)
             for announcement_win in self.announcement_windows.items():
+                announcement_win[1].flush()
                 if announcement_win[1].vsb_pos == 1.0:
                     announcement_win[1].yview("end")
                 announcement_win[1].text.config(state="disabled")
-        self.after(1000, self.get_announcements)
 
     def pack_announcements(self):
         for announcement_win in self.announcement_windows.items():
@@ -406,5 +671,6 @@ class main_gui(Tkinter.Tk):
     #===========================================================================
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     app = main_gui()
     app.mainloop()
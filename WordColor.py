@@ -32,6 +32,13 @@ class groups(object):
         else:
             self.colorName[colorName] = subgroup(colorName, word_list)
 
+    def fill_color_map(self, color_map):
+        """Add word -> colorName for this group's words, first colorName first
+        """
+        for colorName in self.colorName.items():
+            for word in colorName[1].word_list:
+                color_map.setdefault(word, colorName[0])
+
     def find_word(self, word):
         for colorName in self.colorName.items():
             if colorName[1].check_word(word):
@@ -42,9 +49,77 @@ class groups(object):
         if cN is not None:
             cN.set_wordlist(word_list)
 
+SEPARATORS = '.,;:!?)]'  # besides whitespace, what may follow a colored word
+
+def is_word_char(char):
+    return char.isalnum() or char == '_'
+
+class word_trie(object):
+    """Character trie of the words and phrases to color in one group. segment
+    walks it from every word start, so each announcement is scanned once no
+    matter how many words are configured, and the longest word or phrase wins.
+    A word must start and end on a word boundary and be followed by whitespace,
+    one of SEPARATORS or the end of the line.
+    """
+    def __init__(self, color_map, ignore_case=False):
+        self.root = {}
+        self.ignore_case = ignore_case
+        for word in sorted(color_map):
+            if not word:
+                continue
+            node = self.root
+            for char in (word.lower() if ignore_case else word):
+                node = node.setdefault(char, {})
+            node.setdefault('', color_map[word])  # '' marks the end of a word
+
+    def longest_match(self, text, key, start):
+        """(end, colorName) of the longest word starting at start, None
+        """
+        node = self.root.get(key[start])
+        end = start + 1
+        best = None
+        while node is not None:
+            if '' in node and is_word_char(text[end - 1]) and (end == len(text) or text[end].isspace() or text[end] in SEPARATORS):
+                best = (end, node[''])
+            if end == len(text):
+                break
+            node = node.get(key[end])
+            end += 1
+        return best
+
+    def segment(self, text):
+        key = text.lower() if self.ignore_case else text
+        if len(key) != len(text):
+            key = text
+        pieces = []
+        pos = 0
+        start = 0
+        root = self.root
+        while start < len(text):
+            if key[start] in root and (is_word_char(text[start - 1]) if start else False) != is_word_char(text[start]):
+                match = self.longest_match(text, key, start)
+                if match is not None:
+                    end, colorName = match
+                    if start > pos:
+                        pieces.append((text[pos:start], None))
+                    pieces.append((text[start:end], colorName))
+                    pos = end
+                    if end < len(text):
+                        # the separator after the word
+                        pieces.append((text[end], None))
+                        pos = end + 1
+                    start = pos
+                    continue
+            start += 1
+        if pos < len(text):
+            pieces.append((text[pos:], None))
+        return pieces
+
 class color_grouping(object):
     def __init__(self):
         self.groups = OrderedDict([])
+        self.matchers = {}  # group -> word_trie, None for the General-only one
+        self.color_maps = {}  # group -> {word: colorName} with General merged in, None for General only
         self.datafile_path = Config.settings.wordcolor_path
         self.data_format = '\[(?P<group>\w+)\]\[(?P<colorName>\w+|\s*)\]\s*\"(?P<word_list>.+)\"'
         self.reload()
@@ -58,7 +133,7 @@ class color_grouping(object):
     def load_color_data(self):
         """Parse all entry of the wordcolor.txt file
         """
-        self.groups.clear()
+        groups_ = OrderedDict([])  # swapped in whole, the reader thread may be segmenting
         if os.path.isfile(self.datafile_path):
             with open(self.datafile_path, 'r') as fi:
                 for line in fi:
@@ -68,9 +143,55 @@ class color_grouping(object):
                             group = mat.group("group")
                             colorName = mat.group("colorName")
                             word_list_str = mat.group("word_list")
-                            if not self.lookup_group(group):
-                                self.groups[group] = groups(group)
-                            self.lookup_group(group).add_colorName(colorName, word_list_str.split(','))
+                            if group not in groups_:
+                                groups_[group] = groups(group)
+                            groups_[group].add_colorName(colorName, word_list_str.split(','))
+        self.groups = groups_
+        self.build_color_maps()
+        self.compile_matchers()
+
+    def build_color_maps(self):
+        """Flatten every group's words into one word -> colorName dict, the
+        group's own colors taking precedence over General's
+        """
+        general = {}
+        if 'General' in self.groups:
+            self.groups['General'].fill_color_map(general)
+        color_maps = {None: general}
+        for group in self.groups:
+            color_map = {}
+            self.groups[group].fill_color_map(color_map)
+            for word in general:
+                color_map.setdefault(word, general[word])
+            color_maps[group] = color_map
+        self.color_maps = color_maps
+
+    def get_color_map(self, group):
+        """word -> colorName for the announcements of a group
+        """
+        color_maps = self.color_maps
+        if group in color_maps:
+            return color_maps[group]
+        return color_maps.get(None, {})
+
+    def compile_matchers(self):
+        """Build the word_trie of every group once, see segment
+        """
+        matchers = {}
+        for group in self.color_maps:
+            if self.color_maps[group]:
+                matchers[group] = word_trie(self.color_maps[group], Config.settings.word_color_ignore_case)
+            else:
+                matchers[group] = None
+        self.matchers = matchers
+
+    def get_matcher(self, group):
+        """The word_trie of a group, None when it has no words
+        """
+        matchers = self.matchers
+        if group in matchers:
+            return matchers[group]
+        return matchers.get(None)
 
     def get_all_colorname(self):
         colors=[]
@@ -85,13 +206,7 @@ class color_grouping(object):
         check in the default group if nothing found in
         the given group
         """
-        if group in self.groups:
-            cN=self.groups[group].find_word(word)
-            if cN:
-                return cN
-        cND=self.groups['General'].find_word(word)
-        if cND:
-            return cND
+        return self.get_color_map(group).get(word)
 
     def get_all_group_words(self,group):
         """ Return all the words of a group and 
@@ -99,14 +214,24 @@ class color_grouping(object):
         """
 
         l=[]
-        for colorName in self.groups['General'].colorName:
-            for word in self.groups['General'].colorName[colorName].word_list:
-                l.append(word)
+        if 'General' in self.groups:
+            for colorName in self.groups['General'].colorName:
+                for word in self.groups['General'].colorName[colorName].word_list:
+                    l.append(word)
 
         if group in self.groups:
             for colorName in self.groups[group].colorName:
                 for word in self.groups[group].colorName[colorName].word_list:
                     l.append(word)
         return l
-            
+
+    def segment(self, text, group):
+        """Split an announcement into (text, colorname) pieces, colorname None
+        where the text is not highlighted
+        """
+        matcher = self.get_matcher(group)
+        if matcher is None:
+            return [(text, None)]
+        return matcher.segment(text)
+
 wd = color_grouping()
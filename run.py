@@ -1,5 +1,8 @@
-import Window
+import multiprocessing
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    # Imported here: backlog workers started with spawn re-import this module
+    import Window
     root = Window.main_gui()
     root.mainloop()